@@ -1,16 +1,26 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
+import sys
 import time
 import threading
 import numpy as np
 import imclab
-import joblib
-import pandas as pd
+from controller_engine import ControllerEngine, EngineProcess
+from model_registry import ModelRegistry, ModelWatcher
+import online_learning
+from ai_tuner import GainSchedule, TuningWorker, tune, tune_seed
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
 import paho.mqtt.client as mqtt
 from scipy.interpolate import make_interp_spline
 SMOOTH_GRAPH = True
+CONTROL_RATE = 10  # Laju loop PID (Hz), 10-200
+AI_OPTIMIZER = 'cmaes'  # Optimizer gain AI: 'cmaes' atau 'random' (ai_tuner.OPTIMIZERS)
+AI_EVALS = 600          # Evaluasi model per setpoint (bukan batas waktu: hasil bisa diulang)
+ONLINE_LEARNING = True  # Latih ulang model di latar dari data sesi (pid_training_online.csv)
+# --process: loop kontrol + serial di proses terpisah (shared memory),
+# timing tidak terganggu grafik, prediksi AI maupun MQTT
+CONTROL_PROCESS = '--process' in sys.argv
 
 class AIPIDApp:
     def __init__(self, root):
@@ -50,17 +60,27 @@ class AIPIDApp:
         self.running = False
         self.lab = None
         self.ai_model = None
+        self.schedule = None # Tabel gain AI (ai_tuner.GainSchedule)
+        self.registry = ModelRegistry() # Model AI berversi di folder models/
+        self.model_version = None
         self.use_ai = tk.BooleanVar(value=True) 
 
-        # Variabel Internal
-        self.integral = 0.0; self.prev_rpm = 0.0; self.rpm_filtered = 0.0 
+        # Engine kontrol (filter, PID, anti-windup, floor & kick) tanpa UI
+        self.engine = ControllerEngine(self.kp, self.ki, self.kd)
 
         self.load_ai_model()
+        # Tuning AI di thread sendiri: UI dan MQTT tidak pernah menunggu prediksi model
+        self.tuner = TuningWorker(self.tune_gains, self.on_tuned).start()
+        # Model baru dari train_ai_model.py langsung dipakai tanpa restart
+        self.model_watcher = ModelWatcher(self.registry, self.on_new_model, self.model_version).start()
+        # Data sesi jadi data latih; versi model baru masuk lewat model_watcher
+        retrain_every = online_learning.RETRAIN_EVERY if ONLINE_LEARNING else 0
+        self.learner = online_learning.OnlineLearner(self.registry, retrain_every=retrain_every).start()
         
         # Data Logging
-        self.time_data = []; self.sp_data = []; self.rpm_data = []; self.out_data = []
         self.window_size = 150 
-        self.history_time = []; self.history_sp = []; self.history_rpm = []; self.history_out = []
+        self.trend = imclab.RingBuffer(self.window_size, dtype=imclab.TREND_DTYPE) # t, sp, rpm, out
+        self.history = imclab.HistoryStore() # Full history: memori terbatas, sisanya di disk
         self.start_time = 0
 
         self.create_widgets()
@@ -79,27 +99,43 @@ class AIPIDApp:
             
             # Update Setpoint
             new_sp = float(payload)
-            self.setpoint = new_sp
+            self.engine.setpoint = new_sp
             
-            # Update UI Slider (biar sinkron)
-            self.scale_sp.set(new_sp)
-            
-            # Trigger AI Tuning jika perlu
-            if self.use_ai.get() and self.ai_model is not None and new_sp > 500:
-                # Jalankan di thread aman agar tidak macet
-                self.root.after(0, lambda: self.run_ai_tuning(new_sp))
+            # Thread MQTT tidak menyentuh widget Tk: slider & AI diurus thread Tk
+            self.root.after(0, self.on_remote_setpoint, new_sp)
                 
         except Exception as e:
             print(f"❌ Error parsing MQTT: {e}")
 
+    def on_remote_setpoint(self, new_sp):
+        self.setpoint = new_sp
+        self.scale_sp.set(new_sp) # Update UI Slider (biar sinkron)
+        if self.use_ai.get() and self.ai_model is not None and new_sp > 500: self.run_ai_tuning(new_sp)
+
     def load_ai_model(self):
         try:
-            self.ai_model = joblib.load('pid_model.pkl')
-            print("Otak AI Berhasil Dimuat!")
+            if self.registry.latest() is None: self.registry.import_legacy() # pid_model.pkl lama jadi versi pertama
+            self.model_version, self.ai_model, manifest = self.registry.load()
+            # Tabel gain dihitung sekali per model, lalu dipakai ulang dari disk
+            self.schedule = GainSchedule.for_model(self.ai_model, self.registry.path(self.model_version))
+            print(f"Otak AI Berhasil Dimuat! ({self.model_version})")
         except:
             print("Mode AI mati.")
             self.use_ai.set(False)
 
+    def on_new_model(self, version):
+        # Thread ModelWatcher: muat model & tabel di sini, tukar di thread Tk
+        version, model, manifest = self.registry.load(version)
+        schedule = GainSchedule.for_model(model, self.registry.path(version))
+        self.root.after(0, self.swap_model, version, model, schedule)
+
+    def swap_model(self, version, model, schedule):
+        # Loop kontrol tidak ikut berhenti: hanya gain yang diperbarui lewat tuner
+        self.ai_model, self.schedule, self.model_version = model, schedule, version
+        print(f"🔁 Model AI diganti ke {version}")
+        self.lbl_ai_info.config(text=f"Model AI {version} aktif")
+        if self.use_ai.get() and self.setpoint > 500: self.run_ai_tuning(self.setpoint)
+
     def create_widgets(self):
         control_frame = ttk.LabelFrame(self.root, text="AI & Hybrid Control")
         control_frame.pack(side=tk.LEFT, fill=tk.Y, padx=10, pady=10)
@@ -179,91 +215,99 @@ class AIPIDApp:
         self.ent_kp.config(state=state); self.ent_ki.config(state=state); self.ent_kd.config(state=state); self.btn_update.config(state=state)
 
     def run_ai_tuning(self, target_rpm):
-        if self.ai_model is None: return
-        self.lbl_ai_info.config(text="AI Mencari Parameter...")
-        self.root.update_idletasks()
-        num_samples = 2000
-        
-        if target_rpm <= 2500: kp_range = (0.002, 0.007); ki_range = (0.002, 0.007); kd_range = (0.001, 0.003)
-        elif target_rpm <= 3500: kp_range = (0.005, 0.007); ki_range = (0.005, 0.007); kd_range = (0.001, 0.003)
-        elif target_rpm <= 4500: kp_range = (0.007, 0.009); ki_range = (0.007, 0.009); kd_range = (0.003, 0.007)
-        else: kp_range = (0.008, 0.012); ki_range = (0.008, 0.010); kd_range = (0.002, 0.007)
-            
-        kp_c = np.random.uniform(kp_range[0], kp_range[1], num_samples)
-        ki_c = np.random.uniform(ki_range[0], ki_range[1], num_samples)
-        kd_c = np.random.uniform(kd_range[0], kd_range[1], num_samples)
-        sp_arr = np.full(num_samples, target_rpm)
-        input_data = pd.DataFrame({'setpoint': sp_arr, 'kp': kp_c, 'ki': ki_c, 'kd': kd_c})
-        best_idx = np.argmin(self.ai_model.predict(input_data))
-        self.kp = float(kp_c[best_idx]); self.ki = float(ki_c[best_idx]); self.kd = float(kd_c[best_idx])
+        # Hanya antre; permintaan lama yang belum selesai dibatalkan
+        self.lbl_ai_info.config(text="AI Mencari Parameter..."); self.tuner.request(target_rpm)
+
+    def tune_gains(self, target_rpm, cancelled):
+        # Berjalan di thread TuningWorker
+        model, schedule = self.ai_model, self.schedule # Bisa ditukar model baru kapan saja
+        if schedule is None: return None
+        gains = schedule.lookup(target_rpm) # Lookup interpolasi dari tabel gain
+        # Perhalus dari titik tabel dengan optimizer: AI_EVALS evaluasi, seed dari model & setpoint (hasil tetap)
+        gains, mae, evals = tune(model, target_rpm, AI_OPTIMIZER, x0=gains, budget=None, max_evals=AI_EVALS,
+                                 cancelled=cancelled, seed=tune_seed(target_rpm, schedule.model_sha))
+        return gains
+
+    def on_tuned(self, target_rpm, gains):
+        self.root.after(0, self.apply_ai_gains, target_rpm, gains) # Kembali ke thread Tk
+
+    def apply_ai_gains(self, target_rpm, gains):
+        if not self.use_ai.get() or target_rpm != self.setpoint: return # Sudah basi
+        self.kp, self.ki, self.kd = gains
+        self.engine.set_gains(self.kp, self.ki, self.kd)
         
         self.ent_kp.config(state=tk.NORMAL); self.ent_kp.delete(0, tk.END); self.ent_kp.insert(0, f"{self.kp:.4f}")
         self.ent_ki.config(state=tk.NORMAL); self.ent_ki.delete(0, tk.END); self.ent_ki.insert(0, f"{self.ki:.4f}")
         self.ent_kd.config(state=tk.NORMAL); self.ent_kd.delete(0, tk.END); self.ent_kd.insert(0, f"{self.kd:.4f}")
-        if self.use_ai.get(): 
-            self.ent_kp.config(state=tk.DISABLED); self.ent_ki.config(state=tk.DISABLED); self.ent_kd.config(state=tk.DISABLED)
+        self.ent_kp.config(state=tk.DISABLED); self.ent_ki.config(state=tk.DISABLED); self.ent_kd.config(state=tk.DISABLED)
         self.lbl_ai_info.config(text=f"✅ AI Configured for {target_rpm} RPM")
 
     def on_setpoint_change(self, event):
         val = float(self.scale_sp.get())
-        self.setpoint = val
+        self.setpoint = val; self.engine.setpoint = val
         if self.use_ai.get() and self.ai_model is not None and val > 500: self.run_ai_tuning(val)
         elif not self.use_ai.get(): self.manual_update_params()
 
     def manual_update_params(self):
         try: self.kp = float(self.ent_kp.get()); self.ki = float(self.ent_ki.get()); self.kd = float(self.ent_kd.get())
         except: pass
+        self.engine.set_gains(self.kp, self.ki, self.kd)
 
     def reset_system(self):
-        self.integral = 0.0; self.prev_rpm = 0.0; self.rpm_filtered = 0.0
-        self.time_data.clear(); self.sp_data.clear(); self.rpm_data.clear(); self.out_data.clear()
-        self.history_time.clear(); self.history_sp.clear(); self.history_rpm.clear(); self.history_out.clear()
-        self.start_time = time.time()
+        self.engine.reset()
+        self.trend.clear()
+        self.history.clear()
+        self.start_time = time.monotonic()
         self.line_sp.set_data([], []); self.line_rpm.set_data([], []); self.line_out.set_data([], [])
         self.canvas.draw()
 
     def connect_arduino(self):
         try:
-            self.lab = imclab.iMCLab()
+            if CONTROL_PROCESS:
+                self.engine = EngineProcess(self.kp, self.ki, self.kd, setpoint=self.setpoint, rate=CONTROL_RATE).start()
+            else:
+                self.lab = imclab.iMCLab()
             self.lbl_status.config(text="Status: Connected ✅", foreground="green")
             self.btn_connect.config(state=tk.DISABLED)
             self.reset_system()
             self.running = True
-            self.pid_thread = threading.Thread(target=self.pid_loop, daemon=True)
-            self.pid_thread.start()
+            if not CONTROL_PROCESS:
+                self.pid_thread = threading.Thread(target=self.pid_loop, daemon=True)
+                self.pid_thread.start()
             self.animate_plot()
             self.toggle_ai_inputs()
         except Exception as e:
             messagebox.showerror("Error", f"Gagal connect: {e}")
 
     def capture_full_graph(self):
-        if len(self.history_time) < 10:
+        if len(self.history) < 10:
             messagebox.showwarning("Info", "Data belum cukup.")
             return
         filename = filedialog.asksaveasfilename(defaultextension=".png", filetypes=[("PNG Image", "*.png")])
         if not filename: return
         try:
+            hist = self.history.arrays(); h_t = hist['t']
             fig_full = Figure(figsize=(12, 10), dpi=150)
             ax_top = fig_full.add_subplot(211)
-            ax_top.plot(self.history_time, self.history_sp, 'g--', label='Target (SP)', linewidth=1.5)
+            ax_top.plot(h_t, hist['sp'], 'g--', label='Target (SP)', linewidth=1.5)
             
             # Logic Smooth untuk Capture
-            if SMOOTH_GRAPH and len(self.history_time) > 10:
+            if SMOOTH_GRAPH and len(h_t) > 10:
                 try:
-                    x_smooth = np.linspace(min(self.history_time), max(self.history_time), 500)
-                    spl = make_interp_spline(self.history_time, self.history_rpm, k=3)
+                    x_smooth = np.linspace(h_t[0], h_t[-1], 500)
+                    spl = make_interp_spline(h_t, hist['rpm'], k=3)
                     y_smooth = spl(x_smooth)
                     ax_top.plot(x_smooth, y_smooth, 'r-', label='Actual RPM (Smooth)', linewidth=2)
                 except:
-                    ax_top.plot(self.history_time, self.history_rpm, 'r-', label='Actual RPM (Raw)', linewidth=1.5)
+                    ax_top.plot(h_t, hist['rpm'], 'r-', label='Actual RPM (Raw)', linewidth=1.5)
             else:
-                ax_top.plot(self.history_time, self.history_rpm, 'r-', label='Actual RPM (Raw)', linewidth=1.5)
+                ax_top.plot(h_t, hist['rpm'], 'r-', label='Actual RPM (Raw)', linewidth=1.5)
 
             ax_top.set_title(f"Full Response Analysis - RPM (Kp:{self.kp:.4f} Ki:{self.ki:.4f} Kd:{self.kd:.4f})")
             ax_top.set_ylabel("RPM"); ax_top.grid(True); ax_top.legend(loc='upper right')
 
             ax_bot = fig_full.add_subplot(212, sharex=ax_top) 
-            ax_bot.plot(self.history_time, self.history_out, 'b-', label='PWM Output (%)', linewidth=1)
+            ax_bot.plot(h_t, hist['out'], 'b-', label='PWM Output (%)', linewidth=1)
             ax_bot.set_title("Control Signal"); ax_bot.set_ylabel("Power (%)"); ax_bot.set_xlabel("Time (s)"); ax_bot.set_ylim(0, 105); ax_bot.grid(True); ax_bot.legend()
             fig_full.tight_layout(); fig_full.savefig(filename)
             messagebox.showinfo("Sukses", f"Grafik tersimpan: {filename}")
@@ -271,68 +315,36 @@ class AIPIDApp:
             messagebox.showerror("Gagal", f"Error: {e}")
 
     def pid_loop(self):
-        last_time = time.time()
-        KICK_POWER = 83.0; RPM_ALIVE = 500
-
-        while self.running:
-            current_time = time.time()
-            dt = current_time - last_time
-
-            if dt >= 0.1: 
-                try: raw_rpm = self.lab.RPM
-                except: raw_rpm = 0
-
-                self.rpm_filtered = (0.7 * self.rpm_filtered) + (0.3 * raw_rpm)
-                pv = self.rpm_filtered
-                error = self.setpoint - pv
-                P = self.kp * error
-                potential_integral = self.integral + (error * dt)
-                d_rpm = (pv - self.prev_rpm) / dt if dt > 0 else 0
-                D = -self.kd * d_rpm
-                
-                # Dynamic Floor
-                if self.setpoint < 2200: current_floor = 65.0
-                elif self.setpoint < 3500: current_floor = 60.0
-                elif self.setpoint < 4500: current_floor = 57.0
-                else: current_floor = 55.0
-                self.root.after(0, lambda: self.lbl_floor_info.config(text=f"Active Floor: {current_floor}%"))
-
-                op_temp = P + (self.ki * potential_integral) + D
-                if op_temp > 100.0 or (op_temp < current_floor and error < 0): pass
-                else: self.integral = potential_integral
-                I = self.ki * self.integral
-                op = P + I + D
-                
-                if pv < RPM_ALIVE and op > 1.0: op = max(op, KICK_POWER) 
-                else:
-                    if op > 1.0: op = max(op, current_floor)
-
-                op = max(0.0, min(100.0, op))
-                self.lab.op(op)
-                self.prev_rpm = pv
-                last_time = current_time
-
-                elapsed = current_time - self.start_time
-                self.time_data.append(elapsed); self.sp_data.append(self.setpoint)
-                self.rpm_data.append(pv); self.out_data.append(op)
-                if len(self.time_data) > self.window_size:
-                    self.time_data.pop(0); self.sp_data.pop(0); self.rpm_data.pop(0); self.out_data.pop(0)
-
-                self.history_time.append(elapsed); self.history_sp.append(self.setpoint)
-                self.history_rpm.append(pv); self.history_out.append(op)
-                
-                # --- KIRIM DATA KE MQTT ---
-                if (current_time - self.last_mqtt_time) > 0.5:
-                    try:
-                        self.mqtt_client.publish(self.topic_pub_rpm, f"{pv:.1f}")
-                        self.mqtt_client.publish(self.topic_pub_pwm, f"{op:.1f}")
-                        self.mqtt_client.publish(self.topic_pub_sp, f"{self.setpoint:.0f}")
-                        self.last_mqtt_time = current_time 
-                    except: pass
-
-                self.root.after(0, self.update_labels, raw_rpm, op)
-            
-            time.sleep(0.01)
+        # Loop kontrol di engine (jadwal absolut, satu transaksi step() per tick)
+        self.engine.run(self.lab, rate=CONTROL_RATE, on_tick=self.on_tick)
+
+    def on_tick(self, engine):
+        self.record(time.monotonic(), engine.setpoint, engine.pv, engine.op, engine.rpm, engine.floor)
+
+    def poll_process(self):
+        # Mode --process: ambil tick baru dari shared memory proses kontrol
+        for tick in self.engine.read().tolist(): self.record(*tick)
+
+    def record(self, current_time, sp, pv, op, rpm, floor):
+        self.root.after(0, lambda: self.lbl_floor_info.config(text=f"Active Floor: {floor}%"))
+
+        elapsed = current_time - self.start_time
+        self.trend.append(elapsed, sp, pv, op)
+
+        self.history.append(elapsed, sp, pv, op)
+        # Jendela setpoint & gain yang stabil jadi baris data latih
+        self.learner.add(elapsed, sp, self.kp, self.ki, self.kd, sp - pv)
+
+        # --- KIRIM DATA KE MQTT ---
+        if (current_time - self.last_mqtt_time) > 0.5:
+            try:
+                self.mqtt_client.publish(self.topic_pub_rpm, f"{pv:.1f}")
+                self.mqtt_client.publish(self.topic_pub_pwm, f"{op:.1f}")
+                self.mqtt_client.publish(self.topic_pub_sp, f"{sp:.0f}")
+                self.last_mqtt_time = current_time 
+            except: pass
+
+        self.root.after(0, self.update_labels, rpm, op)
 
     def update_labels(self, rpm, out):
         self.lbl_rpm.config(text=f"RPM: {rpm:.0f}")
@@ -340,30 +352,35 @@ class AIPIDApp:
 
     def animate_plot(self):
         if not self.running: return
-        self.line_sp.set_data(self.time_data, self.sp_data)
+        if CONTROL_PROCESS: self.poll_process()
+        data = self.trend.snapshot(); t = data['t'] # snapshot konsisten, thread PID tidak menunggu
+        self.line_sp.set_data(t, data['sp'])
         
-        if SMOOTH_GRAPH and len(self.time_data) > 4:
+        if SMOOTH_GRAPH and len(t) > 4:
             try:
-                x_new = np.linspace(min(self.time_data), max(self.time_data), 300)
-                spl = make_interp_spline(self.time_data, self.rpm_data, k=3) 
+                x_new = np.linspace(t[0], t[-1], 300)
+                spl = make_interp_spline(t, data['rpm'], k=3) 
                 y_smooth = spl(x_new); self.line_rpm.set_data(x_new, y_smooth)
-            except: self.line_rpm.set_data(self.time_data, self.rpm_data)
-        else: self.line_rpm.set_data(self.time_data, self.rpm_data)
+            except ValueError: self.line_rpm.set_data(t, data['rpm'])
+        else: self.line_rpm.set_data(t, data['rpm'])
             
-        self.line_out.set_data(self.time_data, self.out_data)
-        if self.time_data:
-            self.ax1.set_xlim(min(self.time_data), max(self.time_data) + 0.5)
-            max_y = max(5500, max(self.sp_data), max(self.rpm_data)); self.ax1.set_ylim(0, max_y + 200)
-            self.ax2.set_xlim(min(self.time_data), max(self.time_data) + 0.5)
+        self.line_out.set_data(t, data['out'])
+        if len(t):
+            self.ax1.set_xlim(t[0], t[-1] + 0.5)
+            max_y = max(5500, data['sp'].max(), data['rpm'].max()); self.ax1.set_ylim(0, max_y + 200)
+            self.ax2.set_xlim(t[0], t[-1] + 0.5)
         self.canvas.draw(); self.root.after(200, self.animate_plot)
 
     def on_close(self):
-        self.running = False
+        self.running = False; self.engine.stop(); self.tuner.stop(); self.model_watcher.stop(); self.learner.stop()
+        if self.engine.stats(): print("Statistik loop:", self.engine.stats())
+        if isinstance(self.engine, EngineProcess): self.engine.close()
         try: self.mqtt_client.loop_stop() # Stop MQTT
         except: pass
         if self.lab:
             try: self.lab.op(0); self.lab.close()
             except: pass
+        self.history.close()
         self.root.destroy()
 
 if __name__ == "__main__":
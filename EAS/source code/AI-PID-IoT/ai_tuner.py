@@ -0,0 +1,339 @@
+"""
+Gain schedule for the AI auto-tuner.
+
+The model in pid_model.pkl (or its NumPy export pid_model.npz, see
+tree_ensemble.py) predicts the MAE of a run from
+(setpoint, kp, ki, kd). Instead of a new random search on every
+setpoint change, GainSchedule searches once per model over a grid of
+setpoints covering the slider range, keeps the best gains of every
+grid point and answers lookups by linear interpolation:
+
+    schedule = GainSchedule.for_model(model, 'pid_model.pkl')
+    kp, ki, kd = schedule.lookup(3200)
+
+The table is saved as <model>_schedule.npz next to the model and
+reused as long as the model file is unchanged (same SHA-256).
+
+tune() refines gains for one setpoint with a pluggable optimizer from
+OPTIMIZERS (CMA-ES by default) under an evaluation or time budget;
+seeded with tune_seed() and bounded by evaluations only, it always
+gives the same gains for the same model and setpoint. TuningWorker
+runs the tuning off the Tk and MQTT threads, keeping only the newest
+requested setpoint.
+"""
+import os
+import time
+import hashlib
+import threading
+import numpy as np
+
+# Search box of each setpoint tier, as in collect_data.get_search_range:
+# (highest setpoint, (kp_min, kp_max), (ki_min, ki_max), (kd_min, kd_max))
+SEARCH_TIERS = (
+    (2500, (0.002, 0.007), (0.002, 0.007), (0.001, 0.003)),
+    (3500, (0.005, 0.007), (0.005, 0.007), (0.001, 0.003)),
+    (4500, (0.007, 0.009), (0.007, 0.009), (0.003, 0.007)),
+    (float('inf'), (0.008, 0.012), (0.008, 0.010), (0.002, 0.007)),
+)
+MAX_RPM = 5000    # slider range of the apps
+
+def tier_index(setpoint):
+    for i, tier in enumerate(SEARCH_TIERS):
+        if setpoint <= tier[0]:
+            return i
+    return len(SEARCH_TIERS) - 1
+
+def search_range(setpoint):
+    """Lower and upper (kp, ki, kd) bounds for a setpoint."""
+    tier = SEARCH_TIERS[tier_index(setpoint)]
+    low = np.array([b[0] for b in tier[1:]])
+    high = np.array([b[1] for b in tier[1:]])
+    return low, high
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def schedule_path(model_path):
+    return os.path.splitext(model_path)[0] + '_schedule.npz'
+
+def tune_seed(setpoint, model_sha=''):
+    """Optimizer seed fixed by the model file and the setpoint."""
+    key = ('%s:%.3f' % (model_sha, setpoint)).encode()
+    return int(hashlib.sha256(key).hexdigest()[:16], 16)
+
+TIME_BUDGET = 0.25   # seconds per tune() call
+MAX_EVALS = 600      # model evaluations per tune() call
+
+def random_search(objective, x0=None, max_evals=MAX_EVALS, deadline=None,
+                  cancelled=None, seed=None, popsize=None):
+    """
+    Uniform random search in the unit cube, scored in one batch.
+
+    Input:
+        objective (callable): objective(X) -> cost per row, X shape (n, 3)
+            with every coordinate in [0, 1]
+        x0 (array): optional start point, scored along with the samples
+    Output:
+        (best x, best cost, evaluations)
+    """
+    X = np.random.default_rng(seed).random((max_evals, 3))
+    if x0 is not None:
+        X[0] = x0
+    f = np.asarray(objective(X))
+    i = np.argmin(f)
+    return X[i], float(f[i]), len(X)
+
+def cma_es(objective, x0=None, max_evals=MAX_EVALS, deadline=None,
+           cancelled=None, seed=None, popsize=32, sigma=0.5):
+    """
+    CMA-ES in the unit cube. Every generation is scored in one batch;
+    samples outside the cube are clipped onto it. Stops after
+    `max_evals` evaluations, at `deadline` (time.monotonic()), when
+    cancelled() turns True; a run whose step size has collapsed is
+    restarted from a random point.
+
+    Input and output as random_search().
+    """
+    rng = np.random.default_rng(seed)
+    n = 3
+    mu = popsize // 2
+    w = np.log(mu + 0.5) - np.log(np.arange(1, mu + 1))
+    w /= w.sum()
+    mueff = 1.0 / np.sum(w ** 2)
+    cc = (4 + mueff / n) / (n + 4 + 2 * mueff / n)
+    cs = (mueff + 2) / (n + mueff + 5)
+    c1 = 2 / ((n + 1.3) ** 2 + mueff)
+    cmu = min(1 - c1, 2 * (mueff - 2 + 1 / mueff) / ((n + 2) ** 2 + mueff))
+    damps = 1 + 2 * max(0, np.sqrt((mueff - 1) / (n + 1)) - 1) + cs
+    chin = np.sqrt(n) * (1 - 1.0 / (4 * n) + 1.0 / (21 * n ** 2))
+
+    # The surrogate is piecewise constant: seed the search with a wide
+    # uniform batch (plus x0) and start from its best point
+    X = rng.random((min(max_evals, 4 * popsize), n))
+    if x0 is not None:
+        X[0] = np.clip(x0, 0, 1)
+    f = np.asarray(objective(X))
+    evals = start = len(X)
+    best_x = X[np.argmin(f)].copy(); best_f = float(f.min())
+
+    gen = 0
+    while evals + popsize <= max_evals:
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        if cancelled is not None and cancelled():
+            break
+        if gen == 0:   # start at the best point, restarts anywhere in the cube
+            mean = best_x.copy() if evals == start else rng.random(n); step = sigma
+            C = np.eye(n); pc = np.zeros(n); ps = np.zeros(n)
+        gen += 1
+        eigval, B = np.linalg.eigh(C)
+        D = np.sqrt(np.maximum(eigval, 1e-20))
+        X = np.clip(mean + step * (rng.standard_normal((popsize, n)) * D) @ B.T, 0, 1)
+        f = np.asarray(objective(X))
+        evals += popsize
+        order = np.argsort(f)
+        if f[order[0]] < best_f:
+            best_f = float(f[order[0]]); best_x = X[order[0]].copy()
+
+        Y = (X[order[:mu]] - mean) / step   # steps of the clipped samples
+        yw = w @ Y
+        mean = mean + step * yw
+        ps = (1 - cs) * ps + np.sqrt(cs * (2 - cs) * mueff) * (B @ ((B.T @ yw) / D))
+        hsig = np.linalg.norm(ps) / np.sqrt(1 - (1 - cs) ** (2 * gen)) / chin < 1.4 + 2.0 / (n + 1)
+        pc = (1 - cc) * pc + hsig * np.sqrt(cc * (2 - cc) * mueff) * yw
+        C = (1 - c1 - cmu) * C + c1 * (np.outer(pc, pc) + (1 - hsig) * cc * (2 - cc) * C) \
+            + cmu * (Y.T * w) @ Y
+        step *= np.exp((cs / damps) * (np.linalg.norm(ps) / chin - 1))
+        if step * D.max() < 1e-3:
+            gen = 0    # converged: restart while evaluations remain
+    return best_x, best_f, evals
+
+OPTIMIZERS = {'random': random_search, 'cmaes': cma_es}
+
+def tune(model, setpoint, method='cmaes', x0=None, budget=TIME_BUDGET,
+         max_evals=MAX_EVALS, cancelled=None, seed=None):
+    """
+    Search the (kp, ki, kd) with the lowest predicted MAE for a setpoint,
+    inside the search box of its tier.
+
+    Input:
+        model: regressor with predict() on rows (setpoint, kp, ki, kd)
+        method (str): key of OPTIMIZERS
+        x0 (tuple): start gains, e.g. the GainSchedule lookup
+        budget (float): time limit in seconds, None for no limit; the
+            result only depends on `seed` when the search is bounded
+            by max_evals alone
+    Output:
+        ((kp, ki, kd), predicted MAE, model evaluations)
+    """
+    low, high = search_range(setpoint)
+    span = high - low
+    def objective(U):
+        X = np.empty((len(U), 4), dtype=np.float32)
+        X[:, 0] = setpoint
+        X[:, 1:] = low + U * span
+        return model.predict(X)
+    start = None if x0 is None else (np.asarray(x0, dtype=float) - low) / span
+    deadline = None if budget is None else time.monotonic() + budget
+    u, mae, evals = OPTIMIZERS[method](objective, start, max_evals=max_evals,
+                                       deadline=deadline, cancelled=cancelled, seed=seed)
+    return tuple(float(g) for g in low + u * span), mae, evals
+
+class GainSchedule(object):
+    """
+    Table of the best predicted (kp, ki, kd) per setpoint.
+
+    Input:
+        setpoints (array): grid setpoints (rpm), ascending
+        gains (array): best (kp, ki, kd) per grid setpoint, shape (N, 3)
+        mae (array): predicted MAE of those gains
+    """
+
+    def __init__(self, setpoints, gains, mae, model_sha=''):
+        self.model_sha = model_sha   # SHA-256 of the model file, see tune_seed()
+        self.setpoints = np.asarray(setpoints, dtype=float)
+        self.gains = np.asarray(gains, dtype=float)
+        self.mae = np.asarray(mae, dtype=float)
+        self._tiers = np.array([tier_index(sp) for sp in self.setpoints])
+
+    @classmethod
+    def build(cls, model, step=50, samples=2000, seed=0):
+        """
+        Random search of `samples` candidates per grid setpoint, all
+        scored in one predict() call. Every setpoint of a tier uses the
+        same candidates (common random numbers), so the table is
+        deterministic and smooth along the setpoint axis.
+        """
+        setpoints = np.arange(0, MAX_RPM + step, step, dtype=float)
+        unit = np.random.default_rng(seed).random((samples, 3))
+        X = np.empty((len(setpoints), samples, 4), dtype=np.float32)
+        for i, sp in enumerate(setpoints):
+            low, high = search_range(sp)
+            X[i, :, 0] = sp
+            X[i, :, 1:] = low + unit * (high - low)
+        pred = np.asarray(model.predict(X.reshape(-1, 4))).reshape(len(setpoints), samples)
+        best = np.argmin(pred, axis=1)
+        rows = np.arange(len(setpoints))
+        return cls(setpoints, X[rows, best, 1:].astype(float), pred[rows, best])
+
+    @classmethod
+    def load(cls, path, model_sha=None):
+        """Load a saved table; None if missing or made for another model."""
+        try:
+            with np.load(path) as f:
+                if model_sha is not None and str(f['model_sha']) != model_sha:
+                    return None
+                return cls(f['setpoints'], f['gains'], f['mae'], str(f['model_sha']))
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, path, model_sha=''):
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, setpoints=self.setpoints, gains=self.gains, mae=self.mae,
+                 model_sha=np.array(model_sha))
+        os.replace(tmp, path)
+
+    @classmethod
+    def for_model(cls, model, model_path='pid_model.pkl', **build_args):
+        """Cached table of `model`, rebuilt when the model file changes."""
+        sha = file_hash(model_path)
+        path = schedule_path(model_path)
+        schedule = cls.load(path, sha)
+        if schedule is None:
+            schedule = cls.build(model, **build_args)
+            schedule.model_sha = sha
+            try:
+                schedule.save(path, sha)
+            except OSError:
+                pass   # read-only folder: keep the table in memory only
+        return schedule
+
+    def lookup(self, setpoint):
+        """
+        Interpolated (kp, ki, kd) for a setpoint. Only grid points of
+        the setpoint's own tier are used, so the gains stay inside its
+        search box.
+        """
+        inside = self._tiers == tier_index(setpoint)
+        sp = self.setpoints[inside]
+        gains = self.gains[inside]
+        return tuple(float(np.interp(setpoint, sp, gains[:, j])) for j in range(3))
+
+class TuningWorker(object):
+    """
+    Background thread for the AI tuner. Only the newest request counts:
+    a request that arrives while another is waiting replaces it, and a
+    search that is still running is told to give up through `cancelled`.
+
+    Input:
+        tune (callable): tune(setpoint, cancelled) -> (kp, ki, kd) or None;
+            cancelled() turns True once a newer setpoint was requested
+        on_result (callable): on_result(setpoint, gains), called from the
+            worker thread with the result of the newest request only
+    """
+
+    def __init__(self, tune, on_result):
+        self.tune = tune
+        self.on_result = on_result
+        self.requests = 0
+        self.done = 0
+        self.superseded = 0
+        self._cond = threading.Condition()
+        self._pending = None
+        self._seq = 0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def request(self, setpoint):
+        """Queue a setpoint without blocking; safe from any thread."""
+        with self._cond:
+            if self._pending is not None:
+                self.superseded += 1
+            self._pending = setpoint
+            self._seq += 1
+            self.requests += 1
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and self._pending is None:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                setpoint, seq = self._pending, self._seq
+                self._pending = None
+            cancelled = lambda: self._seq != seq or not self._running
+            try:
+                gains = self.tune(setpoint, cancelled)
+            except Exception as e:
+                print('Tuning error: ' + str(e))
+                continue
+            if gains is None:
+                continue
+            if cancelled():
+                self.superseded += 1
+                continue
+            self.done += 1
+            self.on_result(setpoint, gains)
+
+    def stop(self, timeout=2):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def stats(self):
+        return {'requests': self.requests, 'done': self.done,
+                'superseded': self.superseded}
@@ -1,26 +1,98 @@
+import sys
+import math
 import time
 import csv
 import os
+import queue
+import threading
 import numpy as np
 import imclab
+from controller_engine import ControllerEngine
+from online_learning import window_metrics
 from datetime import datetime
 
+class BootstrapSurrogate:
+    # Surrogate cepat untuk active learning: ensemble regresi ridge kuadratik,
+    # tiap anggota dilatih pada sampel bootstrap. Sebaran prediksi antar
+    # anggota = ketidakpastian model di titik itu.
+    def __init__(self, n_models=30, ridge=1e-2, seed=0):
+        self.n_models = n_models
+        self.ridge = ridge
+        self.rng = np.random.default_rng(seed)
+        self.coef = None
+
+    @staticmethod
+    def design(U):
+        # Fitur kuadratik: 1, u_i, u_i*u_j
+        cols = [np.ones(len(U))] + [U[:, i] for i in range(U.shape[1])]
+        cols += [U[:, i] * U[:, j] for i in range(U.shape[1]) for j in range(i, U.shape[1])]
+        return np.column_stack(cols)
+
+    def fit(self, U, y):
+        A = self.design(U); n = A.shape[1]
+        coef = []
+        for _ in range(self.n_models):
+            idx = self.rng.integers(0, len(y), len(y))
+            Ab = A[idx]
+            coef.append(np.linalg.solve(Ab.T @ Ab + self.ridge * np.eye(n), Ab.T @ y[idx]))
+        self.coef = np.array(coef)
+        return self
+
+    def predict(self, U):
+        P = self.design(U) @ self.coef.T # (N, n_models)
+        return P.mean(axis=1), P.std(axis=1)
+
+def expected_improvement(mu, sigma, best):
+    # EI untuk minimasi MAE
+    sigma = np.maximum(sigma, 1e-9)
+    z = (best - mu) / sigma
+    cdf = 0.5 * (1 + np.vectorize(math.erf)(z / math.sqrt(2)))
+    pdf = np.exp(-0.5 * z**2) / math.sqrt(2 * math.pi)
+    return (best - mu) * cdf + sigma * pdf
+
 class SmartTieredCollector:
-    def __init__(self):
+    def __init__(self, clock=time):
+        # clock: modul time (rig asli) atau imclab_sim.SimClock (rig virtual)
+        self.clock = clock
         self.lab = None
+        self.pool = None
+        self.rigs = {} # nama rig -> (lab, clock)
         self.training_data = []
         self.experiment_count = 0
-        self.rpm_filtered = 0.0
+        self.lock = threading.Lock()
         
-    def connect(self):
+    def connect(self, lab=None):
         try:
-            self.lab = imclab.iMCLab()
+            self.lab = lab if lab is not None else imclab.iMCLab()
+            name = 'virtual' if lab is not None else self.lab.sp.port
+            self.rigs = {name: (self.lab, self.clock)}
             print("✅ Terhubung ke iMCLab")
             return True
         except Exception as e:
             print(f"❌ Gagal connect: {e}")
             return False
 
+    def connect_pool(self, ports=None):
+        # Semua board yang terpasang (atau daftar port), dibuka paralel
+        try:
+            self.pool = imclab.DevicePool(ports=ports)
+            self.rigs = dict((name, (lab, self.clock)) for name, lab in self.pool)
+            print(f"✅ Terhubung ke {len(self.rigs)} iMCLab: {', '.join(self.rigs)}")
+            return True
+        except Exception as e:
+            print(f"❌ Gagal connect: {e}")
+            return False
+
+    def connect_virtual(self, n):
+        # n rig virtual, masing-masing dengan jam simulasi sendiri
+        import imclab_sim
+        for i in range(n):
+            clock = imclab_sim.SimClock()
+            self.rigs[f"virtual{i}"] = (imclab_sim.VirtualIMCLab(clock=clock), clock)
+        self.lab, self.clock = self.rigs['virtual0']
+        print(f"✅ {n} rig virtual siap")
+        return True
+
     # Fungsi untuk menentukan Range Pencarian berdasarkan Target RPM
     def get_search_range(self, target_rpm):
         if target_rpm <= 2500:
@@ -48,102 +120,174 @@ class SmartTieredCollector:
                 'kd_min': 0.002, 'kd_max': 0.007
             }
 
-    def run_pid_experiment(self, setpoint, kp, ki, kd, duration=8):
-        print(f"   👉 Tes #{self.experiment_count + 1} | SP:{setpoint:.0f} | PID: {kp:.4f}, {ki:.4f}, {kd:.4f}")
+    def run_pid_experiment(self, setpoint, kp, ki, kd, duration=8, rig=None):
+        # rig: nama rig di self.rigs (default rig pertama/tunggal)
+        lab, clock = self.rigs[rig] if rig else (self.lab, self.clock)
+        tag = f"[{rig}] " if rig else ""
+        print(f"   👉 {tag}Tes #{self.experiment_count + 1} | SP:{setpoint:.0f} | PID: {kp:.4f}, {ki:.4f}, {kd:.4f}")
         
-        integral = 0
-        prev_rpm = 0
-        self.rpm_filtered = 0
         errors = []
         
-        start_time = time.time()
-        last_time = start_time
+        # Engine yang sama dengan aplikasi AI (filter, PID, floor & kick)
+        engine = ControllerEngine(kp, ki, kd, setpoint=setpoint)
         
-        # Logika Floor
-        KICK_POWER = 83.0   
-        SAFE_FLOOR = 35.0   
-        RPM_ALIVE  = 500    
+        def on_tick(engine):
+            # Error setelah 1.5 detik pertama (abaikan fase start)
+            if engine.elapsed > 1.5:
+                errors.append(engine.error)
         
         try:
-            while (time.time() - start_time) < duration:
-                current_time = time.time()
-                dt = current_time - last_time
-                
-                if dt >= 0.1: 
-                    try: raw_rpm = self.lab.RPM
-                    except: raw_rpm = 0
-                    
-                    self.rpm_filtered = (0.7 * self.rpm_filtered) + (0.3 * raw_rpm)
-                    pv = self.rpm_filtered
-                    
-                    error = setpoint - pv
-                    P = kp * error
-                    
-                    potential_integral = integral + (error * dt)
-                    d_rpm = (pv - prev_rpm) / dt if dt > 0 else 0
-                    D = -kd * d_rpm 
-                    
-                    # DYNAMIC SAFE FLOOR
-                    if setpoint < 2200:
-                        current_floor = 65.0 
-                    if setpoint < 3500:
-                        current_floor = 60.0 
-                    if setpoint < 4500:
-                        current_floor = 57.0 
-                    else:
-                        current_floor = 55.0
-                    
-                    # Cek Output Sementara
-                    op_temp = P + (ki * potential_integral) + D
-                    
-                    # Clamp Integral (Pakai current_floor)
-                    if op_temp > 100.0 or (op_temp < current_floor and error < 0):
-                        pass 
-                    else:
-                        integral = potential_integral
-                        
-                    I = ki * integral
-                    op = P + I + D
-                    
-                    # LOGIKA HYBRID
-                    if pv < RPM_ALIVE and op > 1.0:
-                        op = max(op, KICK_POWER) 
-                    else:
-                        if op > 1.0:
-                            op = max(op, current_floor)
-                    
-                    op = max(0.0, min(100.0, op))
-                    self.lab.op(op)
-                    
-                    if (time.time() - start_time) > 1.5:
-                        errors.append(error)
-                        
-                    prev_rpm = pv
-                    last_time = current_time
-                
-                time.sleep(0.01)
-                
+            engine.run(lab, rate=10, duration=duration, on_tick=on_tick,
+                       clock=clock)
         except KeyboardInterrupt:
-            self.lab.op(0); return None
+            lab.op(0); return None
             
-        self.lab.op(0)
+        lab.op(0)
         
-        if len(errors) > 5:
-            mae = np.mean(np.abs(errors))
-            zero_crossings = np.sum(np.diff(np.sign(errors)) != 0)
+        # Definisi metrik dipakai juga oleh online_learning (data sesi aplikasi)
+        result = window_metrics(errors)
+        if result is not None:
+            mae, zero_crossings = result
             
             metrics = {
                 'setpoint': setpoint, 'kp': kp, 'ki': ki, 'kd': kd,
-                'mae': mae, 'oscillations': zero_crossings, 'overshoot_pct': 0 
+                'mae': mae, 'oscillations': zero_crossings, 'overshoot_pct': 0,
+                'rig': rig or next(iter(self.rigs), '')
             }
-            self.training_data.append(metrics)
-            print(f"      ✅ MAE: {mae:.1f} | Osilasi: {zero_crossings}")
-            self.experiment_count += 1
+            with self.lock: # beberapa rig bisa selesai bersamaan
+                self.training_data.append(metrics)
+                self.experiment_count += 1
+            print(f"      ✅ {tag}MAE: {mae:.1f} | Osilasi: {zero_crossings}")
+            return metrics
+
+    def plan_experiments(self, stages, samples_per_stage):
+        # Seluruh rencana eksperimen dibuat di depan: (sp, kp, ki, kd)
+        plan = []
+        for stage in stages:
+            r = self.get_search_range(stage)
+            for i in range(samples_per_stage):
+                # Random di dalam range spesifik
+                kp = np.random.uniform(r['kp_min'], r['kp_max'])
+                ki = np.random.uniform(r['ki_min'], r['ki_max'])
+                kd = np.random.uniform(r['kd_min'], r['kd_max'])
+                # Variasi target di sekitar stage
+                sp = stage + np.random.uniform(-150, 150)
+                plan.append((sp, kp, ki, kd))
+        return plan
+
+    def unit_coords(self, stage, plan):
+        # (sp, kp, ki, kd) -> koordinat 0..1 di dalam kotak tier stage
+        r = self.get_search_range(stage)
+        P = np.asarray(plan, dtype=float).reshape(-1, 4)
+        low = np.array([stage - 150, r['kp_min'], r['ki_min'], r['kd_min']])
+        high = np.array([stage + 150, r['kp_max'], r['ki_max'], r['kd_max']])
+        return (P - low) / (high - low)
+
+    def select_batch(self, stages, n, acquisition='uncertainty', candidates=500):
+        # Pilih n eksperimen berikutnya dari surrogate per stage:
+        # 'uncertainty' = sebaran ensemble terbesar (akurasi model),
+        # 'ei' = expected improvement (cari gain terbaik)
+        pool, score, where, fitted = [], [], [], []
+        for k, stage in enumerate(stages):
+            rows = [d for d in self.training_data
+                    if min(stages, key=lambda s: abs(s - d['setpoint'])) == stage]
+            cand = self.plan_experiments([stage], candidates)
+            U = self.unit_coords(stage, cand)
+            X = self.unit_coords(stage, [(d['setpoint'], d['kp'], d['ki'], d['kd']) for d in rows])
+            if len(rows) < 5:
+                # Belum bisa di-fit: prior = jarak ke titik terukur terdekat
+                sc = np.min(np.linalg.norm(U[:, None, :] - X[None, :, :], axis=2), axis=1) \
+                    if len(rows) else np.full(len(cand), 2.0) # diagonal kotak 4-D
+            else:
+                y = np.array([d['mae'] for d in rows])
+                mu, sigma = BootstrapSurrogate(seed=len(self.training_data) + k).fit(X, y).predict(U)
+                if acquisition == 'uncertainty':
+                    # Dikali jarak ke titik terukur terdekat agar tidak menumpuk di sudut kotak
+                    sc = sigma * np.min(np.linalg.norm(U[:, None, :] - X[None, :, :], axis=2), axis=1)
+                else:
+                    sc = expected_improvement(mu, sigma, y.min())
+            pool += cand; score.append(sc); fitted.append(np.full(len(cand), len(rows) >= 5))
+            where.append(np.column_stack([U, np.full(len(U), 10.0 * k)]))
+        score = np.concatenate(score).astype(float); where = np.vstack(where)
+        fitted = np.concatenate(fitted)
+        # Stage tanpa model tetap didahulukan dengan skor berhingga di atas
+        # semua skor surrogate: top * (1 + jarak ke titik terukur/terpilih)
+        top = np.max(score[fitted], initial=0.0) + 1.0
+        near = np.where(fitted, 0.0, score)
+        score[~fitted] = top * (1.0 + near[~fitted])
+        # Batch beragam: titik dekat eksperimen yang sudah dipilih diturunkan skornya
+        batch = []
+        for _ in range(min(n, len(pool))):
+            i = int(np.argmax(score))
+            batch.append(pool[i])
+            dist = np.linalg.norm(where - where[i], axis=1)
+            open_ = np.isfinite(score)
+            score = np.where((dist < 0.25) & open_ & fitted, score * dist / 0.25, score)
+            near = np.minimum(near, dist)
+            score[open_ & ~fitted] = top * (1.0 + near[open_ & ~fitted])
+            score[i] = -np.inf
+        return batch
+
+    def run_active(self, stages, budget=80, initial_per_stage=8, batch=None,
+                   acquisition='uncertainty'):
+        # Active learning: batch awal acak, lalu tiap batch berikutnya dipilih
+        # surrogate di daerah paling tidak pasti / paling menjanjikan
+        batch = batch or max(4, len(self.rigs))
+        self.run_campaign(self.plan_experiments(stages, initial_per_stage))
+        while len(self.training_data) < budget:
+            n = min(batch, budget - len(self.training_data))
+            print(f"\n🎯 Batch active learning ({acquisition}): {n} eksperimen")
+            done = len(self.training_data)
+            self.run_campaign(self.select_batch(stages, n, acquisition))
+            if len(self.training_data) == done: break # semua eksperimen gagal
+        return self.training_data
+
+    def run_campaign(self, plan, rest=1.5):
+        # Satu worker per rig mengambil eksperimen dari antrean bersama,
+        # jadi lama kampanye turun sebanding jumlah board
+        work = queue.Queue()
+        for item in plan:
+            work.put(item)
+        stop = threading.Event()
+
+        def worker(rig):
+            lab, clock = self.rigs[rig]
+            try:
+                while not stop.is_set():
+                    try: sp, kp, ki, kd = work.get_nowait()
+                    except queue.Empty: return
+                    self.run_pid_experiment(sp, kp, ki, kd, rig=rig)
+                    clock.sleep(rest)
+            except Exception as e:
+                print(f"❌ [{rig}] berhenti: {e}")
+            finally:
+                lab.op(0)
+
+        start = dict((rig, clock.time()) for rig, (lab, clock) in self.rigs.items())
+        done = len(self.training_data)
+        threads = [threading.Thread(target=worker, args=(rig,), daemon=True) for rig in self.rigs]
+        for t in threads: t.start()
+        try:
+            while any(t.is_alive() for t in threads):
+                for t in threads: t.join(0.5)
+        except KeyboardInterrupt:
+            stop.set() # eksperimen yang sedang jalan diselesaikan dulu
+            for t in threads: t.join()
+        # Waktu kampanye = rig yang paling lama (waktu simulasi untuk rig virtual)
+        elapsed = max(clock.time() - start[rig] for rig, (lab, clock) in self.rigs.items())
+        print(f"⏱️ {len(self.training_data) - done} eksperimen di {len(self.rigs)} rig dalam {elapsed/60:.1f} menit")
+        return self.training_data
+
+    def close(self):
+        if self.pool is not None: self.pool.close()
+        else:
+            for lab, clock in self.rigs.values(): lab.close()
 
     def save_to_csv(self):
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"pid_training_SMART_TIERED_{timestamp}.csv"
         keys = self.training_data[0].keys()
+        # File gabungan semua rig; kolom 'rig' menandai asal tiap baris
         with open(filename, 'w', newline='') as f:
             dict_writer = csv.DictWriter(f, fieldnames=keys)
             dict_writer.writeheader()
@@ -152,34 +296,35 @@ class SmartTieredCollector:
         return filename
 
 if __name__ == "__main__":
-    c = SmartTieredCollector()
-    if c.connect():
-        try:
-            print("\n=== KOLEKSI DATA CERDAS BERTINGKAT (ADAPTIVE RANGES) ===")
-            print("Setiap tingkatan RPM memiliki rentang parameter sendiri.")
-            
-            # DAFTAR TARGET (STAGES)
-            stages = [2000, 3000, 4000, 5000]
-            samples_per_stage = 50
-            
-            for stage in stages:
-                print(f"\nMEMULAI TAHAP: {stage} RPM...")
-                
-                r = c.get_search_range(stage)
-                print(f"   Range Kp: {r['kp_min']} - {r['kp_max']}")
-                
-                for i in range(samples_per_stage):
-                    # Random di dalam range spesifik
-                    kp = np.random.uniform(r['kp_min'], r['kp_max'])
-                    ki = np.random.uniform(r['ki_min'], r['ki_max'])
-                    kd = np.random.uniform(r['kd_min'], r['kd_max'])
-                    
-                    # Variasi target di sekitar stage
-                    sp = stage + np.random.uniform(-150, 150)
-                    
-                    c.run_pid_experiment(sp, kp, ki, kd)
-                    time.sleep(1.5) 
-                    
-        except KeyboardInterrupt: pass
-        c.save_to_csv()
-        c.lab.close()
\ No newline at end of file
+    # --virtual [--rigs N] : rig virtual (imclab_sim), jauh lebih cepat dari waktu nyata
+    # --all / --port P ... : semua board terpasang / port tertentu, paralel
+    # --active [ei] [--budget N] : pilih eksperimen dengan active learning
+    args = sys.argv[1:]
+    ports = [args[i + 1] for i, a in enumerate(args[:-1]) if a == '--port']
+    if '--virtual' in args:
+        n = int(args[args.index('--rigs') + 1]) if '--rigs' in args else 1
+        c = SmartTieredCollector()
+        ok = c.connect_virtual(n)
+    elif '--all' in args or ports:
+        c = SmartTieredCollector()
+        ok = c.connect_pool(ports or None)
+    else:
+        c = SmartTieredCollector()
+        ok = c.connect()
+    if ok:
+        print("\n=== KOLEKSI DATA CERDAS BERTINGKAT (ADAPTIVE RANGES) ===")
+        print("Setiap tingkatan RPM memiliki rentang parameter sendiri.")
+        
+        # DAFTAR TARGET (STAGES)
+        stages = [2000, 3000, 4000, 5000]
+        samples_per_stage = 50
+        if '--active' in args:
+            budget = int(args[args.index('--budget') + 1]) if '--budget' in args else 80
+            acquisition = 'ei' if 'ei' in args else 'uncertainty'
+            c.run_active(stages, budget=budget, acquisition=acquisition)
+        else:
+            plan = c.plan_experiments(stages, samples_per_stage)
+            print(f"{len(plan)} eksperimen dibagi ke {len(c.rigs)} rig")
+            c.run_campaign(plan)
+        if c.training_data: c.save_to_csv()
+        c.close()
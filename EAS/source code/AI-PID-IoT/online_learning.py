@@ -0,0 +1,211 @@
+"""
+Training data from everyday AI-PID sessions.
+
+Every time the setpoint or the gains change, the app starts a new
+window. If nothing changes for WINDOW seconds, the window is scored
+exactly like a collect_data.py experiment (window_metrics() on the
+error after the first SETTLE seconds) and becomes one training row in
+pid_training_online.csv. After RETRAIN_EVERY new rows a background
+process continues boosting the latest registry model on the original
+training CSV plus the session rows (xgb_model warm start) and publishes
+the result as a new version, which ModelWatcher then swaps into the
+running app. Once the model would grow past MAX_TREES it is trained
+from scratch instead, so scoring cost and model size stay bounded:
+
+    learner = OnlineLearner(ModelRegistry()).start()
+    learner.add(t, sp, kp, ki, kd, sp - pv)   # every control tick
+    learner.stop()
+"""
+import os
+import csv
+import glob
+import queue
+import threading
+import numpy as np
+import multiprocessing as mp
+from ai_tuner import file_hash
+from model_registry import ModelRegistry, REGISTRY, HERE
+
+SETTLE = 1.5          # s, start-up phase left out of the metrics
+WINDOW = 8.0          # s, experiment length in collect_data.py
+MIN_SETPOINT = 500    # below this the AI tuner is not used either
+RETRAIN_EVERY = 20    # new rows per background training run
+ROUNDS = 20           # boosting rounds added per run
+BASE_TREES = 100      # trees of a model trained from scratch
+MAX_TREES = 200       # larger warm starts are retrained from scratch
+ONLINE_STORE = os.path.join(HERE, 'pid_training_online.csv')
+COLUMNS = ('setpoint', 'kp', 'ki', 'kd', 'mae', 'oscillations', 'overshoot_pct', 'source')
+
+def window_metrics(errors):
+    """MAE and zero crossings of the error, None with too few samples."""
+    if len(errors) <= 5:
+        return None
+    mae = np.mean(np.abs(errors))
+    zero_crossings = np.sum(np.diff(np.sign(errors)) != 0)
+    return mae, zero_crossings
+
+class SessionSegmenter(object):
+    """
+    Cut a stream of control ticks into fixed setpoint and gain windows.
+
+    add() returns a training row (dict with COLUMNS) once a window has
+    lasted `window` seconds, else None. Each change yields at most one
+    row, scored on the same span as an experiment of that length.
+    """
+
+    def __init__(self, settle=SETTLE, window=WINDOW, min_setpoint=MIN_SETPOINT):
+        self.settle = settle
+        self.window = window
+        self.min_setpoint = min_setpoint
+        self.key = None
+        self.t0 = None
+        self.last_t = None
+        self.errors = []
+        self.done = False
+
+    def add(self, t, sp, kp, ki, kd, error):
+        key = (sp, kp, ki, kd)
+        if key != self.key or self.last_t is None or t < self.last_t:
+            self.key, self.t0, self.errors, self.done = key, t, [], False
+        self.last_t = t
+        if self.done:
+            return None
+        age = t - self.t0
+        if age > self.settle:
+            self.errors.append(error)
+        if age < self.window:
+            return None
+        self.done = True
+        metrics = window_metrics(self.errors)
+        if metrics is None or sp <= self.min_setpoint:
+            return None
+        mae, zero_crossings = metrics
+        return {'setpoint': sp, 'kp': kp, 'ki': ki, 'kd': kd, 'mae': float(mae),
+                'oscillations': int(zero_crossings), 'overshoot_pct': 0, 'source': 'session'}
+
+def append_rows(path, rows):
+    new = not os.path.exists(path)
+    with open(path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        if new:
+            writer.writeheader()
+        writer.writerows(rows)
+
+def collected_csv(pattern='pid_training_SMART_TIERED_*.csv'):
+    """Newest collect_data.py output, for models without a train_csv."""
+    files = sorted(glob.glob(os.path.join(HERE, pattern)))
+    return files[-1] if files else None
+
+def retrain(root=REGISTRY, store=ONLINE_STORE, rounds=ROUNDS, max_trees=MAX_TREES):
+    """
+    Add `rounds` boosting rounds to the latest registry model, trained on
+    its training CSV plus the session rows, and publish the result. A
+    model that would get more than `max_trees` trees is replaced by a
+    fresh BASE_TREES model on the same data.
+    Runs in a child process; needs pandas and xgboost.
+    """
+    import joblib
+    import pandas as pd
+    from xgboost import XGBRegressor
+    registry = ModelRegistry(root)
+    parent = registry.latest()
+    manifest = registry.manifest(parent) if parent else {}
+    frames = [pd.read_csv(store)]
+    base_csv = manifest.get('train_csv') or collected_csv()
+    if base_csv and not os.path.isabs(base_csv):
+        base_csv = os.path.join(HERE, base_csv)   # manifests keep the file name only
+    if base_csv and os.path.exists(base_csv):
+        frames.insert(0, pd.read_csv(base_csv))
+    df = pd.concat(frames, ignore_index=True).dropna(subset=['mae', 'setpoint', 'kp', 'ki', 'kd'])
+    X = df[['setpoint', 'kp', 'ki', 'kd']]; y = df['mae']
+
+    pkl = registry.path(parent, 'model.pkl') if parent else None
+    booster = None
+    if pkl and os.path.exists(pkl):
+        booster = joblib.load(pkl).get_booster()   # warm start: keep the old trees
+    parent_trees = booster.num_boosted_rounds() if booster is not None else 0
+    if parent_trees + rounds > max_trees:
+        booster = None   # cap reached: start over instead of growing further
+    model = XGBRegressor(n_estimators=rounds if booster else BASE_TREES, learning_rate=0.1,
+                         max_depth=4, random_state=42, n_jobs=1)
+    model.fit(X, y, xgb_model=booster)
+    trees = model.get_booster().num_boosted_rounds()
+    metrics = {'rows': len(df), 'session_rows': int((df['source'] == 'session').sum()),
+               'train_mae': float(np.mean(np.abs(model.predict(X) - y)))}
+    version = registry.publish(model, train_csv=base_csv, metrics=metrics, parent=parent,
+                               online_store=os.path.basename(store),
+                               online_sha256=file_hash(store), warm_start=booster is not None,
+                               trees=trees, parent_trees=parent_trees, max_trees=max_trees)
+    print('Online learning: published %s (parent %s, %d session rows, %d trees)'
+          % (version, parent, metrics['session_rows'], trees))
+
+class OnlineLearner(object):
+    """
+    Collect session windows and retrain in the background.
+
+    add() is cheap and may be called from the control thread; rows are
+    written and training processes started by the learner's own thread.
+
+    Input:
+        registry (ModelRegistry): where new versions are published
+        store (str): CSV the session rows are appended to
+        retrain_every (int): new rows per training run, 0 to only collect
+    """
+
+    def __init__(self, registry=None, store=ONLINE_STORE, retrain_every=RETRAIN_EVERY):
+        self.registry = registry or ModelRegistry()
+        self.store = store
+        self.retrain_every = retrain_every
+        self.segmenter = SessionSegmenter()
+        self.rows = 0
+        self.pending = 0
+        self.runs = 0
+        self._queue = queue.Queue()
+        self._proc = None
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def add(self, t, sp, kp, ki, kd, error):
+        row = self.segmenter.add(t, sp, kp, ki, kd, error)
+        if row is not None:
+            self._queue.put(row)
+
+    def _run(self):
+        while self._running:
+            try:
+                rows = [self._queue.get(timeout=1.0)]
+            except queue.Empty:
+                rows = []
+            self._flush(rows)
+            if self._proc is not None and not self._proc.is_alive():
+                self._proc.join()
+                self._proc = None
+            if self._proc is None and self.retrain_every and self.pending >= self.retrain_every:
+                self._proc = mp.Process(target=retrain, args=(self.registry.root, self.store),
+                                        daemon=True)
+                self._proc.start()
+                self.pending = 0; self.runs += 1
+        self._flush()
+
+    def _flush(self, rows=()):
+        rows = list(rows)
+        while not self._queue.empty():
+            rows.append(self._queue.get_nowait())
+        if rows:
+            append_rows(self.store, rows)
+            self.rows += len(rows); self.pending += len(rows)
+
+    def stop(self, timeout=2):
+        self._running = False
+        if self._thread:
+            self._thread.join(timeout)
+
+    def stats(self):
+        return {'rows': self.rows, 'pending': self.pending, 'runs': self.runs,
+                'training': self._proc is not None}
@@ -3,7 +3,7 @@ import numpy as np
 from xgboost import XGBRegressor 
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import mean_absolute_error, r2_score
-import joblib
+from model_registry import ModelRegistry
 
 # Load Dataset
 filename = 'pid_training_SMART_TIERED_20251221_134114.csv' 
@@ -47,7 +47,11 @@ print(f"\n📊 Model Performance:")
 print(f"   Mean Absolute Error: {mae_score:.2f} (Semakin kecil semakin akurat)")
 print(f"   R2 Score: {r2:.2f} (Mendekati 1.0 berarti sangat akurat)")
 
-# 6. Simpan Model
-joblib.dump(model, 'pid_model.pkl')
-print("\n✅ Model disimpan sebagai 'pid_model.pkl'")
+# 6. Simpan Model ke registry: versi baru + manifest (fitur, hash CSV, tier, metrik).
+#    Aplikasi AI yang sedang berjalan otomatis beralih ke versi ini.
+version = ModelRegistry().publish(
+    model, train_csv=filename,
+    metrics={'mae': float(mae_score), 'r2': float(r2), 'rows': len(df)},
+    params={'n_estimators': 100, 'learning_rate': 0.1, 'max_depth': 4})
+print(f"\n✅ Model disimpan sebagai versi {version} di folder 'models'")
 print("Sekarang Anda bisa menggunakan 'ai_pid_tuner.py' untuk mencari PID terbaik!")
\ No newline at end of file
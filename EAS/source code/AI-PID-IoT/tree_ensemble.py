@@ -0,0 +1,243 @@
+"""
+XGBoost regressor as flat NumPy node arrays.
+
+TreeEnsemble holds every tree of a trained booster in one set of node
+arrays (feature, threshold, left/right child, leaf value) and scores a
+float32[N, 4] candidate matrix with a handful of vectorised gathers, so
+the apps need neither xgboost, joblib nor pandas at run time:
+
+    model = TreeEnsemble.load('pid_model.npz')
+    mae = model.predict(np.array([[3000, 0.006, 0.006, 0.002]], np.float32))
+
+The apps load these arrays from the model registry: train_ai_model.py
+publishes every trained model with ModelRegistry.publish(), which
+stores the export as models/vNNNN/model.npz, and
+ModelRegistry.import_legacy() does the same for an old pid_model.pkl.
+A stand-alone export still works where xgboost is installed:
+
+    python tree_ensemble.py                    # pid_model.pkl -> pid_model.npz
+    python tree_ensemble.py model.pkl out.npz
+"""
+import os
+import sys
+import json
+import numpy as np
+
+# Rows per pass of predict(). The (rows, trees) leaf masks of a pass
+# should stay in the L2 cache: with 16-leaf trees (uint16 masks) and
+# 100 trees, 512 rows is 100 KB. At 1024 rows of uint64 masks (800 KB)
+# the scorer fell behind xgboost from about 1000 rows on.
+CHUNK = 512
+# lowest set bit of every 16-bit mask, for trees with up to 16 leaves
+LOWEST_BIT = np.zeros(1 << 16, dtype=np.int32)
+LOWEST_BIT[1:] = np.log2(np.arange(1, 1 << 16) & -np.arange(1, 1 << 16))
+
+def model_path(pkl_path):
+    return os.path.splitext(pkl_path)[0] + '.npz'
+
+class TreeEnsemble(object):
+    """
+    Sum of binary regression trees plus a base score (identity link).
+
+    Node i of the flattened arrays splits on X[:, feature[i]] and goes to
+    left[i] if the value is below threshold[i], to right[i] otherwise; a
+    missing value (NaN) goes left when default_left[i]. Leaves point to
+    themselves, so every row can take `depth` steps from its roots.
+
+    Input:
+        roots (array): index of the root node of every tree
+        feature, threshold, left, right, default_left, value (array):
+            node arrays; value is the leaf output (0 for split nodes)
+        base_score (float): added to the sum of the leaves
+        depth (int): longest root-to-leaf path
+        features (tuple): column names, e.g. ('setpoint', 'kp', 'ki', 'kd')
+    """
+
+    def __init__(self, roots, feature, threshold, left, right, default_left,
+                 value, base_score, depth, features=()):
+        self.roots = np.asarray(roots, dtype=np.int32)
+        self.feature = np.asarray(feature, dtype=np.int32)
+        self.threshold = np.asarray(threshold, dtype=np.float32)
+        self.left = np.asarray(left, dtype=np.int32)
+        self.right = np.asarray(right, dtype=np.int32)
+        self.default_left = np.asarray(default_left, dtype=bool)
+        self.value = np.asarray(value, dtype=np.float32)
+        self.base_score = float(base_score)
+        self.depth = int(depth)
+        self.features = tuple(str(f) for f in features)
+        self._compile()
+
+    @classmethod
+    def from_booster(cls, model):
+        """Flatten an XGBRegressor (or Booster) trained with a tree booster."""
+        booster = model.get_booster() if hasattr(model, 'get_booster') else model
+        learner = json.loads(bytes(booster.save_raw('json')))['learner']
+        if learner['gradient_booster']['name'] != 'gbtree':
+            raise ValueError('only gbtree models can be exported')
+        if learner['objective']['name'] != 'reg:squarederror':
+            raise ValueError('unsupported objective ' + learner['objective']['name'])
+        base_score = float(learner['learner_model_param']['base_score'].strip('[]'))
+        roots, nodes, depth = [], [], 0
+        offset = 0
+        for tree in learner['gradient_booster']['model']['trees']:
+            left = np.array(tree['left_children'])
+            right = np.array(tree['right_children'])
+            leaf = left == -1
+            index = np.arange(len(left)) + offset
+            cond = np.array(tree['split_conditions'], dtype=np.float32)
+            nodes.append((np.where(leaf, 0, tree['split_indices']),
+                          np.where(leaf, 0, cond),
+                          np.where(leaf, index, left + offset),
+                          np.where(leaf, index, right + offset),
+                          np.array(tree['default_left'], dtype=bool),
+                          np.where(leaf, cond, 0)))   # leaves keep their output here
+            roots.append(offset)
+            depth = max(depth, tree_depth(left, right))
+            offset += len(left)
+        feature, threshold, left, right, default_left, value = \
+            (np.concatenate(col) for col in zip(*nodes))
+        return cls(roots, feature, threshold, left, right, default_left, value,
+                   base_score, depth, learner.get('feature_names') or ())
+
+    def _compile(self):
+        """
+        Bitvector tables for predict(). Leaves of a tree are numbered left
+        to right and a row starts with every leaf bit set; each split the
+        row does not take to the left clears the leaves of its left
+        subtree, and the exit leaf is the lowest bit left standing. For
+        each feature the clears are accumulated over the thresholds in
+        ascending order, so one searchsorted() per feature finds them all.
+        Masks use the narrowest unsigned type that holds every leaf.
+        """
+        n_trees = len(self.roots)
+        leaf_of = np.full(len(self.feature), -1)
+        first = np.zeros(len(self.feature), dtype=np.int64)   # leftmost leaf below
+        last = np.zeros(len(self.feature), dtype=np.int64)
+        n_leaves = np.zeros(n_trees, dtype=int)
+        tree_of = np.zeros(len(self.feature), dtype=int)
+        for t, root in enumerate(self.roots):
+            stack = [(root, False)]
+            while stack:
+                i, done = stack.pop()
+                tree_of[i] = t
+                if self.left[i] == i:
+                    leaf_of[i] = first[i] = last[i] = n_leaves[t]
+                    n_leaves[t] += 1
+                elif done:
+                    first[i] = first[self.left[i]]; last[i] = last[self.right[i]]
+                else:
+                    stack += [(i, True), (self.right[i], False), (self.left[i], False)]
+        if n_leaves.max() > 64:
+            raise ValueError('trees with more than 64 leaves are not supported')
+        self._leaf_value = np.zeros((n_trees, n_leaves.max()), dtype=np.float32)
+        leaves = leaf_of >= 0
+        self._leaf_value[tree_of[leaves], leaf_of[leaves]] = self.value[leaves]
+        self._tree_base = (np.arange(n_trees) * n_leaves.max()).astype(np.int32)
+        self._mask_type = next(t for t in (np.uint8, np.uint16, np.uint32, np.uint64)
+                               if np.iinfo(t).bits >= n_leaves.max())
+
+        # Splits of each feature: bits to keep when the row goes right
+        split = ~leaves
+        ones = 2**64 - 1
+        keep = np.array([ones ^ (((1 << int(last[l] - first[l] + 1)) - 1) << int(first[l]))
+                         for l in self.left], dtype=np.uint64)   # clears the left subtree
+        self._thresholds, self._tables = [], []
+        for f in range(int(self.feature.max()) + 1 if split.any() else 0):
+            nodes = np.flatnonzero(split & (self.feature == f))
+            nodes = nodes[np.argsort(self.threshold[nodes], kind='stable')]
+            table = np.full((len(nodes) + 2, n_trees), ones, dtype=np.uint64)
+            table[np.arange(1, len(nodes) + 1), tree_of[nodes]] = keep[nodes]
+            np.bitwise_and.accumulate(table[:-1], axis=0, out=table[:-1])
+            # Last row: missing value, only splits without default_left go right
+            right = nodes[~self.default_left[nodes]]
+            for t, k in zip(tree_of[right], keep[right]):
+                table[-1, t] &= k
+            self._thresholds.append(self.threshold[nodes])
+            self._tables.append(table.astype(self._mask_type))   # keeps the low bits
+
+    def predict(self, X):
+        """
+        Predicted output for every row of X (float32[N, n_features]).
+
+        Output:
+            float32[N]
+        """
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X[None]
+        rows = []   # per feature: number of splits each row takes to the right
+        for f, (thr, table) in enumerate(zip(self._thresholds, self._tables)):
+            b = np.searchsorted(thr, X[:, f], side='right')
+            b[np.isnan(X[:, f])] = len(table) - 1
+            rows.append(b)
+        out = np.empty(len(X), dtype=np.float32)
+        values = self._leaf_value.ravel()
+        for i in range(0, len(X), CHUNK):
+            if rows:
+                mask = self._tables[0].take(rows[0][i:i+CHUNK], axis=0)
+                for table, b in zip(self._tables[1:], rows[1:]):
+                    mask &= table.take(b[i:i+CHUNK], axis=0)
+                if self._mask_type in (np.uint8, np.uint16):
+                    leaf = LOWEST_BIT.take(mask)
+                else:
+                    leaf = np.log2(mask & (~mask + mask.dtype.type(1))).astype(np.int32)   # lowest set bit
+            else:
+                leaf = np.zeros((len(X[i:i+CHUNK]), len(self.roots)), dtype=np.int32)
+            leaf += self._tree_base
+            out[i:i+CHUNK] = values.take(leaf).sum(axis=1, dtype=np.float64) + self.base_score
+        return out
+
+    def save(self, path):
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, roots=self.roots, feature=self.feature, threshold=self.threshold,
+                 left=self.left, right=self.right, default_left=self.default_left,
+                 value=self.value, base_score=self.base_score, depth=self.depth,
+                 features=np.array(self.features))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['roots'], f['feature'], f['threshold'], f['left'], f['right'],
+                       f['default_left'], f['value'], f['base_score'], f['depth'],
+                       f['features'].tolist())
+
+    @classmethod
+    def export(cls, pkl_path='pid_model.pkl', path=None, check=True):
+        """
+        Convert a joblib-pickled XGBRegressor into a .npz next to it
+        (needs xgboost and joblib). With `check` the export is compared
+        with xgboost's own predictions first.
+        """
+        import joblib
+        model = joblib.load(pkl_path)
+        ensemble = cls.from_booster(model)
+        if check:
+            err = ensemble.compare(model)
+            if err > 1e-3:
+                raise ValueError('export differs from xgboost by %g' % err)
+        ensemble.save(path or model_path(pkl_path))
+        return ensemble
+
+    def compare(self, model, n=20000, seed=0):
+        """Largest relative difference to model.predict() on random inputs."""
+        rng = np.random.default_rng(seed)
+        X = np.empty((n, 4), dtype=np.float32)
+        X[:, 0] = rng.uniform(0, 5000, n)
+        X[:, 1:] = rng.uniform(0, 0.015, (n, 3))
+        ref = np.asarray(model.predict(X), dtype=np.float64)
+        return float(np.max(np.abs(self.predict(X) - ref) / np.maximum(np.abs(ref), 1.0)))
+
+def tree_depth(left, right):
+    depth = np.zeros(len(left), dtype=int)
+    for i in range(len(left)):   # children always follow their parent
+        if left[i] != -1:
+            depth[left[i]] = depth[right[i]] = depth[i] + 1
+    return int(depth.max())
+
+if __name__ == '__main__':
+    src = sys.argv[1] if len(sys.argv) > 1 else 'pid_model.pkl'
+    dst = sys.argv[2] if len(sys.argv) > 2 else model_path(src)
+    model = TreeEnsemble.export(src, dst)
+    print('%s -> %s: %d trees, %d nodes, depth %d'
+          % (src, dst, len(model.roots), len(model.feature), model.depth))
@@ -1,15 +1,25 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
+import sys
 import time
 import threading
 import numpy as np
 import imclab
-import joblib
-import pandas as pd
+from controller_engine import ControllerEngine, EngineProcess
+from model_registry import ModelRegistry, ModelWatcher
+import online_learning
+from ai_tuner import GainSchedule, TuningWorker, tune, tune_seed
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
 from scipy.interpolate import make_interp_spline
 SMOOTH_GRAPH = True
+CONTROL_RATE = 10  # Laju loop PID (Hz), 10-200
+AI_OPTIMIZER = 'cmaes'  # Optimizer gain AI: 'cmaes' atau 'random' (ai_tuner.OPTIMIZERS)
+AI_EVALS = 600          # Evaluasi model per setpoint (bukan batas waktu: hasil bisa diulang)
+ONLINE_LEARNING = True  # Latih ulang model di latar dari data sesi (pid_training_online.csv)
+# --process: loop kontrol + serial di proses terpisah (shared memory),
+# timing tidak terganggu grafik, prediksi AI maupun MQTT
+CONTROL_PROCESS = '--process' in sys.argv
 
 
 class AIPIDApp:
@@ -27,27 +37,30 @@ class AIPIDApp:
         self.running = False
         self.lab = None
         self.ai_model = None
+        self.schedule = None # Tabel gain AI (ai_tuner.GainSchedule)
+        self.registry = ModelRegistry() # Model AI berversi di folder models/
+        self.model_version = None
         self.use_ai = tk.BooleanVar(value=True) 
 
-        # Variabel Internal PID
-        self.integral = 0.0   
-        self.prev_rpm = 0.0    
-        self.rpm_filtered = 0.0 
+        # Engine kontrol (filter, PID, anti-windup, floor & kick) tanpa UI
+        self.engine = ControllerEngine(self.kp, self.ki, self.kd)
 
         self.load_ai_model()
+        # Tuning AI di thread sendiri: UI tidak pernah menunggu prediksi model
+        self.tuner = TuningWorker(self.tune_gains, self.on_tuned).start()
+        # Model baru dari train_ai_model.py langsung dipakai tanpa restart
+        self.model_watcher = ModelWatcher(self.registry, self.on_new_model, self.model_version).start()
+        # Data sesi jadi data latih; versi model baru masuk lewat model_watcher
+        retrain_every = online_learning.RETRAIN_EVERY if ONLINE_LEARNING else 0
+        self.learner = online_learning.OnlineLearner(self.registry, retrain_every=retrain_every).start()
         
-        # Data Logging
-        self.time_data = []
-        self.sp_data = []
-        self.rpm_data = []
-        self.out_data = []
+        # Data Logging (ring buffer NumPy: append O(1), view tanpa salin)
         self.window_size = 150 
+        self.trend = imclab.RingBuffer(self.window_size, dtype=imclab.TREND_DTYPE)
         
-        # Data Full History
-        self.history_time = []
-        self.history_sp = []
-        self.history_rpm = []
-        self.history_out = []
+        # Data Full History: hanya 4096 data terbaru di memori, sisanya
+        # dipindah ke file float32 sementara (aman untuk run semalaman)
+        self.history = imclab.HistoryStore()
 
         self.start_time = 0
 
@@ -56,12 +69,31 @@ class AIPIDApp:
 
     def load_ai_model(self):
         try:
-            self.ai_model = joblib.load('pid_model.pkl')
-            print("File Berhasil Dimuat!")
+            if self.registry.latest() is None:
+                self.registry.import_legacy() # pid_model.pkl lama jadi versi pertama
+            self.model_version, self.ai_model, manifest = self.registry.load()
+            print(f"Model {self.model_version} Berhasil Dimuat!")
+            # Tabel gain dihitung sekali per model, lalu dipakai ulang dari disk
+            self.schedule = GainSchedule.for_model(self.ai_model, self.registry.path(self.model_version))
         except:
-            print("'pid_model.pkl' belum ada.")
+            print("Model AI belum ada (folder 'models' / 'pid_model.pkl').")
             self.use_ai.set(False)
 
+    def on_new_model(self, version):
+        # Berjalan di thread ModelWatcher: muat model & tabel gain di sini,
+        # lalu tukar di thread Tk
+        version, model, manifest = self.registry.load(version)
+        schedule = GainSchedule.for_model(model, self.registry.path(version))
+        self.root.after(0, self.swap_model, version, model, schedule)
+
+    def swap_model(self, version, model, schedule):
+        # Loop kontrol tidak ikut berhenti: hanya gain yang diperbarui lewat tuner
+        self.ai_model, self.schedule, self.model_version = model, schedule, version
+        print(f"🔁 Model AI diganti ke {version}")
+        self.lbl_ai_info.config(text=f"Model AI {version} aktif")
+        if self.use_ai.get() and self.setpoint > 500:
+            self.run_ai_tuning(self.setpoint)
+
     def create_widgets(self):
         # FRAME KONTROL
         control_frame = ttk.LabelFrame(self.root, text="AI & Hybrid Control")
@@ -153,41 +185,42 @@ class AIPIDApp:
         self.btn_update.config(state=state)
 
     def run_ai_tuning(self, target_rpm):
-        if self.ai_model is None: return
+        # Hanya antre; permintaan lama yang belum selesai dibatalkan
         self.lbl_ai_info.config(text="🤖 AI Mencari Parameter...")
-        self.root.update_idletasks()
-        num_samples = 2000
-        
-        if target_rpm <= 2500:
-            kp_range = (0.002, 0.007); ki_range = (0.002, 0.007); kd_range = (0.001, 0.003)
-        elif target_rpm <= 3500:
-            kp_range = (0.005, 0.007); ki_range = (0.005, 0.007); kd_range = (0.001, 0.003)
-        elif target_rpm <= 4500:
-            kp_range = (0.007, 0.009); ki_range = (0.007, 0.009); kd_range = (0.003, 0.007)
-        else:
-            kp_range = (0.008, 0.012); ki_range = (0.008, 0.010); kd_range = (0.002, 0.007)
-            
-        kp_c = np.random.uniform(kp_range[0], kp_range[1], num_samples)
-        ki_c = np.random.uniform(ki_range[0], ki_range[1], num_samples)
-        kd_c = np.random.uniform(kd_range[0], kd_range[1], num_samples)
-        sp_arr = np.full(num_samples, target_rpm)
-        
-        input_data = pd.DataFrame({'setpoint': sp_arr, 'kp': kp_c, 'ki': ki_c, 'kd': kd_c})
-        best_idx = np.argmin(self.ai_model.predict(input_data))
-        
-        self.kp = float(kp_c[best_idx]); self.ki = float(ki_c[best_idx]); self.kd = float(kd_c[best_idx])
+        self.tuner.request(target_rpm)
+
+    def tune_gains(self, target_rpm, cancelled):
+        # Berjalan di thread TuningWorker
+        model, schedule = self.ai_model, self.schedule # Bisa ditukar model baru kapan saja
+        if schedule is None: return None
+        # Lookup interpolasi dari tabel gain sebagai titik awal
+        gains = schedule.lookup(target_rpm)
+        # Perhalus dengan optimizer (CMA-ES) di dalam kotak tier: AI_EVALS evaluasi,
+        # seed dari model & setpoint, jadi setpoint yang sama selalu memberi gain yang sama
+        gains, mae, evals = tune(model, target_rpm, AI_OPTIMIZER, x0=gains, budget=None,
+                                 max_evals=AI_EVALS, cancelled=cancelled,
+                                 seed=tune_seed(target_rpm, schedule.model_sha))
+        return gains
+
+    def on_tuned(self, target_rpm, gains):
+        # Hasil dari thread worker, diteruskan ke thread Tk
+        self.root.after(0, self.apply_ai_gains, target_rpm, gains)
+
+    def apply_ai_gains(self, target_rpm, gains):
+        if not self.use_ai.get() or target_rpm != self.setpoint: return # Sudah basi
+        self.kp, self.ki, self.kd = gains
+        self.engine.set_gains(self.kp, self.ki, self.kd)
         
         self.ent_kp.config(state=tk.NORMAL); self.ent_kp.delete(0, tk.END); self.ent_kp.insert(0, f"{self.kp:.4f}")
         self.ent_ki.config(state=tk.NORMAL); self.ent_ki.delete(0, tk.END); self.ent_ki.insert(0, f"{self.ki:.4f}")
         self.ent_kd.config(state=tk.NORMAL); self.ent_kd.delete(0, tk.END); self.ent_kd.insert(0, f"{self.kd:.4f}")
         
-        if self.use_ai.get(): 
-            self.ent_kp.config(state=tk.DISABLED); self.ent_ki.config(state=tk.DISABLED); self.ent_kd.config(state=tk.DISABLED)
+        self.ent_kp.config(state=tk.DISABLED); self.ent_ki.config(state=tk.DISABLED); self.ent_kd.config(state=tk.DISABLED)
         self.lbl_ai_info.config(text=f"✅ AI Configured for {target_rpm} RPM")
 
     def on_setpoint_change(self, event):
         val = float(self.scale_sp.get())
-        self.setpoint = val
+        self.setpoint = val; self.engine.setpoint = val
         if self.use_ai.get() and self.ai_model is not None and val > 500:
             self.run_ai_tuning(val)
         elif not self.use_ai.get():
@@ -196,27 +229,30 @@ class AIPIDApp:
     def manual_update_params(self):
         try: self.kp = float(self.ent_kp.get()); self.ki = float(self.ent_ki.get()); self.kd = float(self.ent_kd.get())
         except: pass
+        self.engine.set_gains(self.kp, self.ki, self.kd)
 
     def reset_system(self):
-        self.integral = 0.0
-        self.prev_rpm = 0.0
-        self.rpm_filtered = 0.0
-        self.time_data.clear(); self.sp_data.clear(); self.rpm_data.clear(); self.out_data.clear()
-        self.history_time.clear(); self.history_sp.clear(); self.history_rpm.clear(); self.history_out.clear()
-        self.start_time = time.time()
+        self.engine.reset()
+        self.trend.clear()
+        self.history.clear()
+        self.start_time = time.monotonic()
         self.line_sp.set_data([], []); self.line_rpm.set_data([], []); self.line_out.set_data([], [])
         self.canvas.draw()
         print("🔄 System Reset")
 
     def connect_arduino(self):
         try:
-            self.lab = imclab.iMCLab()
+            if CONTROL_PROCESS:
+                self.engine = EngineProcess(self.kp, self.ki, self.kd, setpoint=self.setpoint, rate=CONTROL_RATE).start()
+            else:
+                self.lab = imclab.iMCLab()
             self.lbl_status.config(text="Status: Connected ✅", foreground="green")
             self.btn_connect.config(state=tk.DISABLED)
             self.reset_system()
             self.running = True
-            self.pid_thread = threading.Thread(target=self.pid_loop, daemon=True)
-            self.pid_thread.start()
+            if not CONTROL_PROCESS:
+                self.pid_thread = threading.Thread(target=self.pid_loop, daemon=True)
+                self.pid_thread.start()
             self.animate_plot()
             self.toggle_ai_inputs()
         except Exception as e:
@@ -224,7 +260,7 @@ class AIPIDApp:
 
     # Fungsi Capture
     def capture_full_graph(self):
-        if len(self.history_time) < 10:
+        if len(self.history) < 10:
             messagebox.showwarning("Info", "Data belum cukup.")
             return
         
@@ -232,32 +268,35 @@ class AIPIDApp:
         if not filename: return
         
         try:
+            # Seluruh sesi (memori + disk) sebagai array per kolom
+            hist = self.history.arrays()
+            h_t = hist['t']
             fig_full = Figure(figsize=(12, 10), dpi=150)
             
             # SUBPLOT 1: RPM Response
             ax_top = fig_full.add_subplot(211)
             
             # Plot Target
-            ax_top.plot(self.history_time, self.history_sp, 'g--', label='Target (SP)', linewidth=1.5)
+            ax_top.plot(h_t, hist['sp'], 'g--', label='Target (SP)', linewidth=1.5)
             
             # --- LOGIKA SMOOTHING UNTUK GAMBAR ---
-            if SMOOTH_GRAPH and len(self.history_time) > 10:
+            if SMOOTH_GRAPH and len(h_t) > 10:
                 try:
                     # Buat titik X baru yang lebih rapat (misal 500 titik)
                     # Agar kurva terlihat sangat halus
-                    x_smooth = np.linspace(min(self.history_time), max(self.history_time), 500)
+                    x_smooth = np.linspace(h_t[0], h_t[-1], 500)
                     
                     # Buat Spline
-                    spl = make_interp_spline(self.history_time, self.history_rpm, k=3)
+                    spl = make_interp_spline(h_t, hist['rpm'], k=3)
                     y_smooth = spl(x_smooth)
                     
                     # Plot Kurva Halus
                     ax_top.plot(x_smooth, y_smooth, 'r-', label='Actual RPM (Smoothed)', linewidth=2)
                 except:
                     # Fallback ke RAW jika gagal
-                    ax_top.plot(self.history_time, self.history_rpm, 'r-', label='Actual RPM (Raw)', linewidth=1.5)
+                    ax_top.plot(h_t, hist['rpm'], 'r-', label='Actual RPM (Raw)', linewidth=1.5)
             else:
-                ax_top.plot(self.history_time, self.history_rpm, 'r-', label='Actual RPM (Raw)', linewidth=1.5)
+                ax_top.plot(h_t, hist['rpm'], 'r-', label='Actual RPM (Raw)', linewidth=1.5)
 
             ax_top.set_title(f"Full Response Analysis - RPM (Kp:{self.kp:.4f} Ki:{self.ki:.4f} Kd:{self.kd:.4f})")
             ax_top.set_ylabel("RPM")
@@ -266,7 +305,7 @@ class AIPIDApp:
 
             # SUBPLOT 2: PWM Output
             ax_bot = fig_full.add_subplot(212, sharex=ax_top) 
-            ax_bot.plot(self.history_time, self.history_out, 'b-', label='PWM Output (%)', linewidth=1)
+            ax_bot.plot(h_t, hist['out'], 'b-', label='PWM Output (%)', linewidth=1)
             ax_bot.set_title("Control Signal (PWM Output)")
             ax_bot.set_ylabel("Power (%)")
             ax_bot.set_xlabel("Time (seconds)")
@@ -282,60 +321,27 @@ class AIPIDApp:
             messagebox.showerror("Gagal", f"Error: {e}")
 
     def pid_loop(self):
-        last_time = time.time()
-        KICK_POWER = 83.0; RPM_ALIVE = 500
-
-        while self.running:
-            current_time = time.time()
-            dt = current_time - last_time
-
-            if dt >= 0.1: 
-                try: raw_rpm = self.lab.RPM
-                except: raw_rpm = 0
-
-                self.rpm_filtered = (0.7 * self.rpm_filtered) + (0.3 * raw_rpm)
-                pv = self.rpm_filtered
-                error = self.setpoint - pv
-                P = self.kp * error
-                potential_integral = self.integral + (error * dt)
-                d_rpm = (pv - self.prev_rpm) / dt if dt > 0 else 0
-                D = -self.kd * d_rpm
-                
-                # Dynamic Floor (Sesuai Code Collect Data)
-                if self.setpoint < 2200: current_floor = 65.0
-                elif self.setpoint < 3500: current_floor = 60.0
-                elif self.setpoint < 4500: current_floor = 57.0
-                else: current_floor = 55.0
-                self.root.after(0, lambda: self.lbl_floor_info.config(text=f"Active Floor: {current_floor}%"))
-
-                op_temp = P + (self.ki * potential_integral) + D
-                if op_temp > 100.0 or (op_temp < current_floor and error < 0): pass
-                else: self.integral = potential_integral
-                
-                I = self.ki * self.integral
-                op = P + I + D
-                
-                if pv < RPM_ALIVE and op > 1.0: op = max(op, KICK_POWER) 
-                else:
-                    if op > 1.0: op = max(op, current_floor)
-
-                op = max(0.0, min(100.0, op))
-                self.lab.op(op)
-                self.prev_rpm = pv
-                last_time = current_time
-
-                elapsed = current_time - self.start_time
-                self.time_data.append(elapsed); self.sp_data.append(self.setpoint)
-                self.rpm_data.append(pv); self.out_data.append(op)
-                if len(self.time_data) > self.window_size:
-                    self.time_data.pop(0); self.sp_data.pop(0); self.rpm_data.pop(0); self.out_data.pop(0)
-
-                self.history_time.append(elapsed); self.history_sp.append(self.setpoint)
-                self.history_rpm.append(pv); self.history_out.append(op)
-
-                self.root.after(0, self.update_labels, raw_rpm, op)
-            
-            time.sleep(0.01)
+        # Loop kontrol di engine (jadwal absolut, satu transaksi step() per tick)
+        self.engine.run(self.lab, rate=CONTROL_RATE, on_tick=self.on_tick)
+
+    def on_tick(self, engine):
+        self.record(time.monotonic(), engine.setpoint, engine.pv, engine.op, engine.rpm, engine.floor)
+
+    def poll_process(self):
+        # Mode --process: ambil tick baru dari shared memory proses kontrol
+        for tick in self.engine.read().tolist(): self.record(*tick)
+
+    def record(self, current_time, sp, pv, op, rpm, floor):
+        self.root.after(0, lambda: self.lbl_floor_info.config(text=f"Active Floor: {floor}%"))
+
+        elapsed = current_time - self.start_time
+        self.trend.append(elapsed, sp, pv, op)
+
+        self.history.append(elapsed, sp, pv, op)
+        # Jendela setpoint & gain yang stabil jadi baris data latih
+        self.learner.add(elapsed, sp, self.kp, self.ki, self.kd, sp - pv)
+
+        self.root.after(0, self.update_labels, rpm, op)
 
     def update_labels(self, rpm, out):
         self.lbl_rpm.config(text=f"RPM: {rpm:.0f}")
@@ -343,35 +349,43 @@ class AIPIDApp:
 
     def animate_plot(self):
         if not self.running: return
-        self.line_sp.set_data(self.time_data, self.sp_data)
+        if CONTROL_PROCESS: self.poll_process()
+        # Snapshot konsisten dari ring buffer: panjang kolom selalu sama
+        # walau thread PID menulis bersamaan, dan thread PID tidak menunggu
+        data = self.trend.snapshot()
+        t = data['t']
+        self.line_sp.set_data(t, data['sp'])
         
         # Smooth Curve Logic
-        if SMOOTH_GRAPH and len(self.time_data) > 4:
+        if SMOOTH_GRAPH and len(t) > 4:
             try:
-                x_new = np.linspace(min(self.time_data), max(self.time_data), 300)
-                spl = make_interp_spline(self.time_data, self.rpm_data, k=3) 
+                x_new = np.linspace(t[0], t[-1], 300)
+                spl = make_interp_spline(t, data['rpm'], k=3) 
                 y_smooth = spl(x_new)
                 self.line_rpm.set_data(x_new, y_smooth)
-            except: self.line_rpm.set_data(self.time_data, self.rpm_data)
+            except ValueError: self.line_rpm.set_data(t, data['rpm'])
         else:
-            self.line_rpm.set_data(self.time_data, self.rpm_data)
+            self.line_rpm.set_data(t, data['rpm'])
             
-        self.line_out.set_data(self.time_data, self.out_data)
+        self.line_out.set_data(t, data['out'])
 
-        if self.time_data:
-            self.ax1.set_xlim(min(self.time_data), max(self.time_data) + 0.5)
-            max_y = max(5500, max(self.sp_data), max(self.rpm_data))
+        if len(t):
+            self.ax1.set_xlim(t[0], t[-1] + 0.5)
+            max_y = max(5500, data['sp'].max(), data['rpm'].max())
             self.ax1.set_ylim(0, max_y + 200)
-            self.ax2.set_xlim(min(self.time_data), max(self.time_data) + 0.5)
+            self.ax2.set_xlim(t[0], t[-1] + 0.5)
 
         self.canvas.draw()
         self.root.after(200, self.animate_plot)
 
     def on_close(self):
-        self.running = False
+        self.running = False; self.engine.stop(); self.tuner.stop(); self.model_watcher.stop(); self.learner.stop()
+        if self.engine.stats(): print("Statistik loop:", self.engine.stats())
+        if isinstance(self.engine, EngineProcess): self.engine.close()
         if self.lab:
             try: self.lab.op(0); self.lab.close()
             except: pass
+        self.history.close()
         self.root.destroy()
 
 if __name__ == "__main__":
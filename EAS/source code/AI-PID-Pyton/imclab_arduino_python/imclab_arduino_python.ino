@@ -6,11 +6,30 @@
 #include <Arduino.h>
 
 // --- Constants ---
-const String vers = "1.0";     // version of this firmware
+const String vers = "1.3";     // version of this firmware
 const int baud = 115200;       // serial baud rate
 const char sp = ' ';           // command separator
 const char nl = '\n';          // command terminator
 
+// --- Binary Protocol (opsional, diaktifkan host lewat "BIN 1") ---
+// Frame 7 byte: [SYNC][kode perintah][float32 little-endian][checksum XOR]
+const byte SYNC = 0xA5;
+const int FRAME_SIZE = 7;
+const byte CMD_NONE = 0x00;
+const byte CMD_OP   = 0x01;
+const byte CMD_RPM  = 0x02;
+const byte CMD_VER  = 0x03;
+const byte CMD_LED  = 0x04;
+const byte CMD_X    = 0x05;
+const byte CMD_STEP = 0x06;
+const byte CMD_BIN  = 0x07;
+const byte CMD_STREAM = 0x08;
+
+// Frame telemetri (mode streaming, 10 byte):
+// [TSYNC][millis uint32][rpm float32][checksum XOR]
+const byte TSYNC = 0x5A;
+const int TELEMETRY_SIZE = 10;
+
 // --- Pin Definitions (ESP32) ---
 // Motor Driver L298N
 const int motor1Pin1 = 27;     // Input 1 L298N
@@ -40,6 +59,11 @@ float rpm_filtered = 0;
 // --- Global Variables ---
 char Buffer[64];
 String cmd;                    
+byte cmdCode = CMD_NONE;       // perintah hasil parsing (ASCII maupun biner)
+bool binaryMode = false;
+byte frame[FRAME_SIZE];
+unsigned long streamPeriod = 0; // periode push telemetri (ms), 0 = mati
+unsigned long lastStream = 0;
 double pv = 0;                 
 float level;
 double op = 0;                 
@@ -51,6 +75,19 @@ void IRAM_ATTR isr() {
   rev++;
 }
 
+// --- Kode perintah dari nama perintah ASCII ---
+byte commandCode(String name) {
+  if (name == "OP") return CMD_OP;
+  if (name == "RPM") return CMD_RPM;
+  if ((name == "V") or (name == "VER")) return CMD_VER;
+  if (name == "LED") return CMD_LED;
+  if (name == "X") return CMD_X;
+  if (name == "STEP") return CMD_STEP;
+  if (name == "BIN") return CMD_BIN;
+  if (name == "STREAM") return CMD_STREAM;
+  return CMD_NONE;
+}
+
 // --- Parsing Serial (Sama seperti sebelumnya) ---
 void parseSerial(void) {
   int ByteCount = Serial.readBytesUntil(nl,Buffer,sizeof(Buffer));
@@ -65,6 +102,53 @@ void parseSerial(void) {
   String data = read_.substring(idx+1);
   data.trim();
   pv = data.toFloat();
+  cmdCode = commandCode(cmd);
+}
+
+// --- Checksum XOR dari semua byte di antara sync dan checksum ---
+byte checksum(byte *buf, int size) {
+  byte sum = 0;
+  for (int i = 1; i < size - 1; i++) sum ^= buf[i];
+  return sum;
+}
+
+// --- Parsing Frame Biner ---
+void parseFrame(void) {
+  cmdCode = CMD_NONE;
+  // Cari byte sync dulu agar stream kembali sinkron bila ada byte hilang
+  if (Serial.read() != SYNC) return;
+  frame[0] = SYNC;
+  if (Serial.readBytes(frame + 1, FRAME_SIZE - 1) != FRAME_SIZE - 1) return;
+  if (checksum(frame, FRAME_SIZE) != frame[FRAME_SIZE - 1]) return;
+
+  float value;
+  memcpy(&value, frame + 2, sizeof(value));
+  pv = value;
+  cmdCode = frame[1];
+}
+
+void sendFrame(byte code, float value) {
+  byte out[FRAME_SIZE];
+  out[0] = SYNC;
+  out[1] = code;
+  memcpy(out + 2, &value, sizeof(value));
+  out[FRAME_SIZE - 1] = checksum(out, FRAME_SIZE);
+  Serial.write(out, FRAME_SIZE);
+}
+
+void sendTelemetry(unsigned long now) {
+  byte out[TELEMETRY_SIZE];
+  out[0] = TSYNC;
+  memcpy(out + 1, &now, sizeof(now));
+  memcpy(out + 5, &rpm, sizeof(rpm));
+  out[TELEMETRY_SIZE - 1] = checksum(out, TELEMETRY_SIZE);
+  Serial.write(out, TELEMETRY_SIZE);
+}
+
+// Balas dengan angka: teks di mode ASCII, frame di mode biner
+void replyValue(float value) {
+  if (binaryMode) sendFrame(cmdCode, value);
+  else Serial.println(value);
 }
 
 // --- Menghitung RPM ---
@@ -104,34 +188,67 @@ void calculateRPM() {
 
 // --- Eksekusi Perintah ---
 void dispatchCommand(void) {
-  if (cmd == "OP") {   
-    // Mengatur Kecepatan Motor
-    // Input pv dari Python 0-100%
-    op = max(0.0, min(100.0, pv)); 
-    
-    // Mapping 0-100% ke 0-255 (PWM 8-bit)
-    iwrite = map(op, 0, 100, 0, 255);
-    
-    ledcWrite(pwmChannel, iwrite);
-    Serial.println(op);
-  }
-  else if (cmd == "RPM") {
-    calculateRPM();    
-    Serial.println(rpm); // Kirim nilai RPM ke Python
-  }
-  else if ((cmd == "V") or (cmd == "VER")) {
-    Serial.println("iMCLab Firmware Version " + vers);
-  }
-  else if (cmd == "LED") {
-    level = max(0.0, min(100.0, pv));
-    iwrite = map(level, 0, 100, 0, 255);  
-    ledcWrite(ledChannel, iwrite);      
-    Serial.println(level);
-  }  
-  else if (cmd == "X") {
-    ledcWrite(pwmChannel, 0);
-    Serial.println("Stop");
+  switch (cmdCode) {
+    case CMD_OP:
+      // Mengatur Kecepatan Motor
+      // Input pv dari Python 0-100%
+      op = max(0.0, min(100.0, pv)); 
+      
+      // Mapping 0-100% ke 0-255 (PWM 8-bit)
+      iwrite = map(op, 0, 100, 0, 255);
+      
+      ledcWrite(pwmChannel, iwrite);
+      replyValue(op);
+      break;
+    case CMD_RPM:
+      calculateRPM();    
+      replyValue(rpm); // Kirim nilai RPM ke Python
+      break;
+    case CMD_STEP:
+      // Set output motor lalu kirim RPM dalam satu balasan
+      // (menggantikan pasangan OP + RPM tiap tick kontrol)
+      op = max(0.0, min(100.0, pv));
+      iwrite = map(op, 0, 100, 0, 255);
+      ledcWrite(pwmChannel, iwrite);
+      calculateRPM();
+      replyValue(rpm);
+      break;
+    case CMD_VER:
+      if (binaryMode) sendFrame(CMD_VER, vers.toFloat());
+      else Serial.println("iMCLab Firmware Version " + vers);
+      break;
+    case CMD_LED:
+      level = max(0.0, min(100.0, pv));
+      iwrite = map(level, 0, 100, 0, 255);  
+      ledcWrite(ledChannel, iwrite);      
+      replyValue(level);
+      break;
+    case CMD_X:
+      ledcWrite(pwmChannel, 0);
+      if (binaryMode) sendFrame(CMD_X, 0);
+      else Serial.println("Stop");
+      break;
+    case CMD_BIN:
+      // Ganti mode protokol; balasan dikirim dulu dengan mode lama
+      if (binaryMode) sendFrame(CMD_BIN, pv);
+      else Serial.println("BIN");
+      binaryMode = (pv != 0);
+      if (!binaryMode) streamPeriod = 0;
+      break;
+    case CMD_STREAM:
+      // Push telemetri RPM periodik (Hz), hanya di mode biner
+      if (binaryMode and pv > 0) {
+        float rate = min(200.0, pv);
+        streamPeriod = 1000.0 / rate;
+        lastStream = millis();
+        replyValue(rate);
+      } else {
+        streamPeriod = 0;
+        replyValue(0);
+      }
+      break;
   }
+  cmdCode = CMD_NONE;
 }
 
 // --- 2. SETUP (Perbaikan Utama) ---
@@ -164,6 +281,20 @@ void setup() {
 }
 
 void loop() {
-  parseSerial();
+  if (binaryMode) {
+    if (Serial.available() > 0) parseFrame();
+  } else {
+    parseSerial();
+  }
   dispatchCommand();
+
+  // Push telemetri tanpa menunggu permintaan dari host
+  if (streamPeriod > 0) {
+    unsigned long now = millis();
+    if (now - lastStream >= streamPeriod) {
+      calculateRPM();
+      sendTelemetry(now);
+      lastStream = now;
+    }
+  }
 }
\ No newline at end of file
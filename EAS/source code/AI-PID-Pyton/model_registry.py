@@ -0,0 +1,209 @@
+"""
+Versioned store for the AI tuner models.
+
+Every trained model is published as its own directory with a manifest,
+and a LATEST file names the version the apps should use:
+
+    models/
+        LATEST               -> v0002
+        v0001/manifest.json  feature order, training CSV hash, tiers, metrics
+        v0001/model.npz      TreeEnsemble arrays (no xgboost needed)
+        v0001/model.pkl      original XGBRegressor, for further training (optional)
+        v0002/...
+
+    registry = ModelRegistry()
+    version = registry.publish(xgb_model, train_csv='data.csv', metrics={'mae': 41.2})
+    version, model, manifest = registry.load()
+
+A version directory is written under a temporary name and renamed into
+place, then LATEST is replaced, so a reader never sees a half-written
+model. ModelWatcher polls LATEST and reports new versions to a running
+app, which swaps the model without a restart.
+"""
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+from ai_tuner import SEARCH_TIERS, file_hash
+from tree_ensemble import TreeEnsemble, model_path
+
+FORMAT = 1
+FEATURES = ('setpoint', 'kp', 'ki', 'kd')
+# next to this file, whatever the working directory the app starts in
+HERE = os.path.dirname(os.path.abspath(__file__))
+REGISTRY = os.path.join(HERE, 'models')
+LEGACY_MODEL = os.path.join(HERE, 'pid_model.pkl')
+
+def tier_bounds():
+    """SEARCH_TIERS as JSON (null for the open-ended top tier)."""
+    return [[None if sp == float('inf') else sp, list(kp), list(ki), list(kd)]
+            for sp, kp, ki, kd in SEARCH_TIERS]
+
+class ModelRegistry(object):
+    """
+    Versioned model directory.
+
+    Input:
+        root (str): registry directory, created on the first publish
+    """
+
+    def __init__(self, root=REGISTRY):
+        self.root = root
+
+    def versions(self):
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return []
+        return sorted(n for n in names if n.startswith('v') and n[1:].isdigit())
+
+    def latest(self):
+        """Version named by LATEST, None for an empty registry."""
+        try:
+            with open(os.path.join(self.root, 'LATEST')) as f:
+                return f.read().strip() or None
+        except OSError:
+            versions = self.versions()
+            return versions[-1] if versions else None
+
+    def path(self, version, name='model.npz'):
+        return os.path.join(self.root, version, name)
+
+    def manifest(self, version):
+        with open(self.path(version, 'manifest.json')) as f:
+            return json.load(f)
+
+    def load(self, version=None):
+        """
+        Load a version (default the latest).
+
+        Output:
+            (version, TreeEnsemble, manifest)
+        """
+        version = version or self.latest()
+        if version is None:
+            raise LookupError('no model in ' + self.root)
+        manifest = self.manifest(version)
+        if manifest.get('format') != FORMAT:
+            raise ValueError('%s: unsupported format %r' % (version, manifest.get('format')))
+        if tuple(manifest.get('features', ())) != FEATURES:
+            raise ValueError('%s: feature order %r' % (version, manifest.get('features')))
+        return version, TreeEnsemble.load(self.path(version)), manifest
+
+    def publish(self, model, train_csv=None, metrics=None, parent=None, **extra):
+        """
+        Store a trained XGBRegressor (or a bare TreeEnsemble) as the next
+        version and point LATEST to it. The NumPy export of an
+        XGBRegressor is checked against xgboost first.
+
+        Output:
+            version name, e.g. 'v0003'
+        """
+        if isinstance(model, TreeEnsemble):
+            ensemble, model, export_error = model, None, None   # NumPy arrays only
+        else:
+            ensemble = TreeEnsemble.from_booster(model)
+            export_error = ensemble.compare(model)
+            if export_error > 1e-3:
+                raise ValueError('export differs from xgboost by %g' % export_error)
+        if tuple(ensemble.features) not in ((), FEATURES):
+            raise ValueError('feature order %r, expected %r' % (ensemble.features, FEATURES))
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        tmp = tempfile.mkdtemp(prefix='.publish-', dir=self.root)
+        try:
+            ensemble.save(os.path.join(tmp, 'model.npz'))
+            if model is not None:
+                import joblib
+                joblib.dump(model, os.path.join(tmp, 'model.pkl'))
+            manifest = {
+                'format': FORMAT,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'features': list(FEATURES),
+                'train_csv': os.path.basename(train_csv) if train_csv else None,
+                'train_sha256': file_hash(train_csv) if train_csv else None,
+                'tiers': tier_bounds(),
+                'metrics': dict(metrics or {}, export_error=export_error),
+                'parent': parent,
+                'model_sha256': file_hash(os.path.join(tmp, 'model.npz')),
+            }
+            manifest.update(extra)
+            while True:
+                versions = self.versions()
+                version = 'v%04d' % (int(versions[-1][1:]) + 1 if versions else 1)
+                manifest['version'] = version
+                with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+                    json.dump(manifest, f, indent=2)
+                try:
+                    os.rename(tmp, os.path.join(self.root, version))
+                    break
+                except OSError:
+                    if not os.path.isdir(os.path.join(self.root, version)):
+                        raise
+                    # another trainer took this number first: try the next one
+        except:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self.set_latest(version)
+        return version
+
+    def set_latest(self, version):
+        """Point LATEST to a version, e.g. to roll back."""
+        if not os.path.isdir(os.path.join(self.root, version)):
+            raise LookupError(version)
+        tmp = os.path.join(self.root, 'LATEST.tmp')
+        with open(tmp, 'w') as f:
+            f.write(version + '\n')
+        os.replace(tmp, os.path.join(self.root, 'LATEST'))
+
+    def import_legacy(self, pkl_path=LEGACY_MODEL, **manifest):
+        """Publish a stand-alone pid_model.pkl as the first version."""
+        try:
+            import joblib
+            model = joblib.load(pkl_path)
+        except ImportError:
+            model = TreeEnsemble.load(model_path(pkl_path))   # no xgboost here: use its .npz
+        return self.publish(model, legacy=os.path.basename(pkl_path), **manifest)
+
+class ModelWatcher(object):
+    """
+    Poll a registry's LATEST file in a background thread and call
+    on_change(version) from that thread when it names a new version.
+
+    Input:
+        registry (ModelRegistry): registry to watch
+        on_change (callable): on_change(version)
+        version (str): version already loaded
+        interval (float): seconds between polls
+    """
+
+    def __init__(self, registry, on_change, version=None, interval=1.0):
+        self.registry = registry
+        self.on_change = on_change
+        self.version = version
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            version = self.registry.latest()
+            if version is None or version == self.version:
+                continue
+            try:
+                self.on_change(version)
+            except Exception as e:
+                print('Model %s not loaded: %s' % (version, e))
+            self.version = version   # a broken version is skipped, not retried
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(self.interval + 1)
@@ -1,6 +1,17 @@
+import os
 import sys
+import json
 import time
+import queue
+import shutil
+import asyncio
+import struct
+import bisect
+import tempfile
+import threading
 import numpy as np
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 try:
     import serial
 except:
@@ -8,73 +19,837 @@ except:
     pip.main(['install','pyserial'])
     import serial
 from serial.tools import list_ports
-        
+
+# USB VID:PID of the supported boards
+BOARD_IDS = {
+    '16D0:0613': 'Arduino Uno',
+    '1A86:7523': 'Arduino HDuino',
+    '2341:8036': 'Arduino Leonardo',
+    '10C4:EA60': 'Arduino ESP32',
+    '1A86:55D4': 'Arduino ESP32 - Tipe yg berbeda',
+}
+
+# last good port per board serial number ('_last' = most recent board)
+PORT_CACHE = os.path.join(os.path.expanduser('~'), '.imclab_ports.json')
+PROBE_INTERVAL = 0.2  # seconds between VER polls while the board boots
+CACHE_PROBE_TIMEOUT = 3.0
+
+# Binary framing (firmware 1.2+): sync byte, command code, float32 payload
+# and an XOR checksum over the code and payload bytes.
+FRAME = struct.Struct('<BBfB')
+SYNC = 0xA5
+CMD_CODES = {'OP': 0x01, 'RPM': 0x02, 'VER': 0x03, 'LED': 0x04,
+             'X': 0x05, 'STEP': 0x06, 'BIN': 0x07, 'STREAM': 0x08}
+BINARY_MIN_VERSION = (1, 2)
+STEP_MIN_VERSION = (1, 1)    # combined OP + RPM exchange
+
+# Telemetry pushed by the firmware in streaming mode (1.3+): sync byte,
+# device millis (uint32), RPM (float32) and an XOR checksum.
+TELEMETRY = struct.Struct('<BIfB')
+TSYNC = 0x5A
+STREAM_MIN_VERSION = (1, 3)
+SAMPLE_DTYPE = np.dtype([('t', 'f8'), ('rpm', 'f4')])
+# live trend of the apps: time, setpoint, measured speed and output
+TREND_DTYPE = np.dtype([('t', 'f8'), ('sp', 'f4'), ('rpm', 'f4'), ('out', 'f4')])
+TREND_COLUMNS = TREND_DTYPE.names
+
+# commands whose ASCII reply must parse as a number
+NUMERIC_REPLIES = ('OP', 'RPM', 'STEP', 'LED', 'STREAM')
+# upper edges (ms) of the round-trip histogram buckets; the last bucket
+# collects everything slower
+RTT_BUCKETS_MS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+# columns of a control log, same order and header as save_txt()
+LOG_COLUMNS = ('Time (sec)', 'Ouput Controller (%)', 'RPM (rpm)', 'Set Point (rpm)')
+
+def checksum(frame):
+    c = 0
+    for b in frame[1:-1]:
+        c ^= b
+    return c
+
+def parse_version(text):
+    """Return the firmware version from a VER reply as a tuple, e.g. (1, 2)."""
+    try:
+        return tuple(int(x) for x in text.split()[-1].split('.'))
+    except (AttributeError, IndexError, ValueError):
+        return (0,)
+
+def find_ports(serial_number=None):
+    """Return every serial port whose USB VID:PID matches a supported board."""
+    ports = []
+    for port in list_ports.comports():
+        if not any(port[2].startswith('USB VID:PID=' + vid) for vid in BOARD_IDS):
+            continue
+        if serial_number is None or port.serial_number == serial_number:
+            ports.append(port)
+    return ports
+
+def load_port_cache():
+    try:
+        with open(PORT_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_port_cache(device, serial_number=None):
+    cache = load_port_cache()
+    cache['_last'] = device
+    if serial_number:
+        cache[serial_number] = device
+    tmp = PORT_CACHE + '.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp, PORT_CACHE)
+    except OSError:
+        pass  # the cache is only a startup shortcut
+
+def probe(device, baud=115200, timeout=10, cancel=None):
+    """
+    Open `device` and poll VER until the firmware answers.
+
+    Replaces a fixed sleep after opening the port: the board is ready as
+    soon as it replies, which is usually well under a second.
+
+    Output:
+        (serial.Serial, VER reply) or None if there was no answer
+        before the timeout or `cancel` (threading.Event) was set
+    """
+    try:
+        sp = serial.Serial(port=device, baudrate=baud, timeout=PROBE_INTERVAL)
+    except (serial.SerialException, OSError, ValueError):
+        return None
+    deadline = time.time() + timeout
+    # a firmware left in binary mode switches back to ASCII on this frame;
+    # in ASCII mode it is a garbage line that gets no reply
+    reset = bytearray(FRAME.pack(SYNC, CMD_CODES['BIN'], 0.0, 0))
+    reset[-1] = checksum(reset)
+    try:
+        sp.write(bytes(reset) + b'\n')
+        while time.time() < deadline and not (cancel and cancel.is_set()):
+            sp.reset_input_buffer()
+            sp.write(b'VER\n')
+            sp.flush()
+            reply = sp.readline().decode('UTF-8', 'replace').strip()
+            if reply.startswith('iMCLab'):
+                return sp, reply
+    except (serial.SerialException, OSError):
+        pass
+    sp.close()
+    return None
+
+def probe_ports(devices, baud=115200, timeout=10):
+    """
+    Probe all candidate devices in parallel and return the first that
+    answers as (serial.Serial, VER reply), or None.
+    """
+    if not devices:
+        return None
+    found = threading.Event()
+    result = None
+    with ThreadPoolExecutor(max_workers=len(devices)) as pool:
+        futures = [pool.submit(probe, d, baud, timeout, found) for d in devices]
+        for f in as_completed(futures):
+            r = f.result()
+            if r is None:
+                continue
+            if result is None:
+                result = r
+                found.set()  # stop the other probes
+            else:
+                r[0].close()
+    return result
+
+def ask_port():
+    """Print port hints and ask for the port; fails when not interactive."""
+    print('Arduino COM port not found')
+    print('Please ensure that the USB cable is connected')
+    print('--- Printing Serial Ports ---')            
+    for port in list(serial.tools.list_ports.comports()):
+        print(port[0] + ' ' + port[1] + ' ' + port[2])
+    print('For Windows:')
+    print('  Open device manager, select "Ports (COM & LPT)"')
+    print('  Look for COM port of Arduino such as COM4')
+    print('For MacOS:')
+    print('  Open terminal and type: ls /dev/*.')
+    print('  Search for /dev/tty.usbmodem* or /dev/tty.usbserial*. The port number is *.')
+    print('For Linux')
+    print('  Open terminal and type: ls /dev/tty*')
+    print('  Search for /dev/ttyUSB* or /dev/ttyACM*. The port number is *.')
+    print('')
+    if not sys.stdin or not sys.stdin.isatty():
+        raise IOError('Arduino COM port not found')
+    port = input('Input port: ')
+    # or hard-code it here
+    #port = 'COM3' # for Windows
+    #port = '/dev/tty.wchusbserial1410' # for MacOS
+    return port
+
+class DriverStats(object):
+    """
+    Per-command round-trip instrumentation for the serial drivers.
+
+    record() is called once per exchange with its outcome: 'ok',
+    'timeout' (no complete reply), 'garbled' (reply failed to decode
+    or check) or 'error' (the write failed). The optional callback gets
+    (cmd, rtt_seconds, status) for every exchange. Frames pushed by the
+    firmware have no round trip and are only counted, see pushed().
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.reset()
+
+    def reset(self):
+        self.commands = {}
+        self.telemetry = {'count': 0, 'ok': 0, 'garbled': 0, 'bytes_in': 0}
+
+    def pushed(self, bytes_in, ok):
+        """Count one telemetry frame pushed by the firmware."""
+        self.telemetry['count'] += 1
+        self.telemetry['ok' if ok else 'garbled'] += 1
+        self.telemetry['bytes_in'] += bytes_in
+
+    def record(self, cmd, start, bytes_out, bytes_in, status):
+        rtt = time.perf_counter() - start
+        st = self.commands.get(cmd)
+        if st is None:
+            st = self.commands[cmd] = {
+                'count': 0, 'ok': 0, 'timeout': 0, 'garbled': 0, 'error': 0,
+                'bytes_out': 0, 'bytes_in': 0, 'total_s': 0.0, 'max_s': 0.0,
+                'histogram': [0] * (len(RTT_BUCKETS_MS) + 1)}
+        st['count'] += 1
+        st[status] += 1
+        st['bytes_out'] += bytes_out
+        st['bytes_in'] += bytes_in
+        st['total_s'] += rtt
+        st['max_s'] = max(st['max_s'], rtt)
+        st['histogram'][bisect.bisect_left(RTT_BUCKETS_MS, rtt * 1000.0)] += 1
+        if self.callback is not None:
+            self.callback(cmd, rtt, status)
+
+    def snapshot(self):
+        """
+        Return {cmd: stats} plus an 'ALL' entry summing every command.
+        Each entry has count, ok, timeout, garbled, error, bytes_out,
+        bytes_in, mean_ms, max_ms and histogram ({'<=1ms': n, ...}).
+        Streamed frames are not part of 'ALL'; while streaming, a
+        'TELEMETRY' entry counts them (count, ok, garbled, bytes_in).
+        """
+        labels = ['<=%gms' % b for b in RTT_BUCKETS_MS] \
+            + ['>%gms' % RTT_BUCKETS_MS[-1]]
+        out = {}
+        total = None
+        # list(): record() may add a command from another thread meanwhile
+        for cmd, st in list(self.commands.items()):
+            if total is None:
+                total = dict(st, histogram=list(st['histogram']))
+            else:
+                for k in ('count', 'ok', 'timeout', 'garbled', 'error',
+                          'bytes_out', 'bytes_in', 'total_s'):
+                    total[k] += st[k]
+                total['max_s'] = max(total['max_s'], st['max_s'])
+                total['histogram'] = [a + b for a, b in
+                                      zip(total['histogram'], st['histogram'])]
+            out[cmd] = st
+        if total is not None:
+            out['ALL'] = total
+        result = {}
+        for cmd, st in out.items():
+            d = dict((k, v) for k, v in st.items()
+                     if k not in ('total_s', 'max_s', 'histogram'))
+            d['mean_ms'] = st['total_s'] / st['count'] * 1000.0 if st['count'] else 0.0
+            d['max_ms'] = st['max_s'] * 1000.0
+            d['histogram'] = dict(zip(labels, st['histogram']))
+            result[cmd] = d
+        if self.telemetry['count']:
+            result['TELEMETRY'] = dict(self.telemetry)
+        return result
+
+class ChunkedLog(object):
+    """
+    Append-only, crash-safe session log of float32 rows.
+
+    Rows go into a preallocated chunk; each full chunk is written as a
+    numbered .npy segment in the session directory, so memory use stays
+    constant however long the run is. Files are written to a temporary
+    name and renamed, and the partial chunk is saved as tail.npy every
+    `flush_interval` seconds, so a crash loses at most that much data.
+    Segments can be memory-mapped by readers while the log is written.
+    Inside a real-time loop pass fsync=False: the files still survive a
+    crash of the program, only not a power cut, and append() does not
+    wait for the disk.
+
+        log = ChunkedLog()
+        log.append(t, u, y, sp)
+        ...
+        log.close()
+        log.to_csv('data.txt')
+
+    Input:
+        path (str): session directory, default log_<timestamp>
+        columns (tuple): column names, default LOG_COLUMNS
+        chunk_rows (int): rows per segment
+        flush_interval (float): seconds between tail flushes
+        fsync (bool): force every written file to disk
+    """
+
+    def __init__(self, path=None, columns=LOG_COLUMNS, chunk_rows=4096,
+                 flush_interval=5.0, fsync=True):
+        if path is None:
+            path = 'log_' + datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.path = path
+        self.columns = tuple(columns)
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'columns.json'), 'w') as f:
+            json.dump(list(self.columns), f)
+        self._chunk = np.zeros((chunk_rows, len(self.columns)), dtype=np.float32)
+        self._n = 0
+        # continue numbering when appending to an existing session; rows
+        # left in tail.npy by a crashed run become a regular segment
+        self._segment = len(self._segment_files())
+        tail = os.path.join(path, 'tail.npy')
+        if os.path.exists(tail):
+            os.replace(tail, os.path.join(path, 'seg_%06d.npy' % self._segment))
+            self._segment += 1
+        self._last_flush = time.monotonic()
+
+    def __len__(self):
+        rows = sum(len(seg) for seg in self.segments(include_tail=False))
+        return rows + self._n
+
+    def append(self, *row):
+        self._chunk[self._n] = row
+        self._n += 1
+        if self._n == len(self._chunk):
+            self._save('seg_%06d.npy' % self._segment, self._chunk)
+            self._segment += 1
+            self._n = 0
+            self._remove('tail.npy')
+            self._last_flush = time.monotonic()
+        elif time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Save the rows of the current chunk as tail.npy."""
+        if self._n:
+            self._save('tail.npy', self._chunk[:self._n])
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+    def _save(self, name, data):
+        tmp = os.path.join(self.path, name + '.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, name))
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            pass
+
+    def _segment_files(self):
+        return sorted(f for f in os.listdir(self.path)
+                      if f.startswith('seg_') and f.endswith('.npy'))
+
+    def segments(self, include_tail=True):
+        """Memory-mapped arrays of all saved segments, oldest first."""
+        names = self._segment_files()
+        if include_tail and os.path.exists(os.path.join(self.path, 'tail.npy')):
+            names.append('tail.npy')
+        return [np.load(os.path.join(self.path, n), mmap_mode='r') for n in names]
+
+    def to_csv(self, filename='data.txt'):
+        """Export the whole session as CSV, one segment at a time."""
+        self.flush()
+        with open(filename, 'w') as f:
+            f.write(', '.join(self.columns) + '\n')
+            for seg in self.segments():
+                np.savetxt(f, seg, delimiter=',', fmt='%.6g')
+        return filename
+
+class HistoryStore(ChunkedLog):
+    """
+    Whole-session history with bounded memory.
+
+    Only the newest `memory_rows` records are kept in RAM; older ones
+    are paged out as float32 segments (16 bytes per 4-column record
+    instead of about 130 for four lists of floats) and read back
+    memory-mapped. float32 keeps the time column to 1 ms for the first
+    4.6 hours and to 10 ms for 46 hours.
+
+        hist = HistoryStore()
+        hist.append(t, sp, rpm, out)
+        for block in hist:          # 2-D float32 arrays, oldest first
+            ...
+        cols = hist.arrays()        # {'t': array, 'sp': array, ...}
+
+    Input:
+        path (str): directory for the segments, default a temporary
+            directory that close() removes
+        columns (tuple): column names, default TREND_COLUMNS
+        memory_rows (int): records held in memory before paging out
+    """
+
+    def __init__(self, path=None, columns=TREND_COLUMNS, memory_rows=4096):
+        self._temporary = path is None
+        # append() runs in the control thread, readers in the GUI thread
+        self._lock = threading.Lock()
+        if path is None:
+            path = tempfile.mkdtemp(prefix='imclab_history_')
+        # scratch data only: no fsync, so a page-out never waits for the disk
+        ChunkedLog.__init__(self, path, columns, chunk_rows=memory_rows,
+                            flush_interval=float('inf'), fsync=False)
+
+    def append(self, *row):
+        with self._lock:
+            ChunkedLog.append(self, *row)
+
+    def __iter__(self):
+        # list the segments and copy the chunk in one go, so a chunk paged
+        # out meanwhile is neither skipped nor read twice; the segments are
+        # mapped after the lock is released, so append() never waits on it
+        with self._lock:
+            names = ['seg_%06d.npy' % i for i in range(self._segment)]
+            recent = self._chunk[:self._n].copy()
+        for name in names:
+            try:
+                yield np.load(os.path.join(self.path, name), mmap_mode='r')
+            except OSError:
+                return   # clear() removed it meanwhile
+        if len(recent):
+            yield recent
+
+    def arrays(self):
+        """The whole session as one array per column."""
+        blocks = list(self) or [np.zeros((0, len(self.columns)), np.float32)]
+        data = np.concatenate(blocks)
+        return dict((name, data[:, i]) for i, name in enumerate(self.columns))
+
+    def clear(self):
+        """Drop all records."""
+        with self._lock:
+            for name in self._segment_files():
+                self._remove(name)
+            self._remove('tail.npy')
+            self._segment = 0
+            self._n = 0
+
+    def close(self):
+        if self._temporary:
+            shutil.rmtree(self.path, ignore_errors=True)
+        else:
+            ChunkedLog.close(self)
+
+class Scheduler(object):
+    """
+    Drift-free periodic scheduler for control loops.
+
+    Ticks are due at absolute deadlines start + k * period measured
+    with monotonic_ns(), so loop work does not add to the period, the
+    rate does not drift and wall-clock jumps have no effect. Between
+    ticks the thread sleeps until the next deadline instead of polling.
+
+        sched = Scheduler(rate=50)
+        while running:
+            dt = sched.wait()   # seconds since the previous tick
+            ...
+
+    Input:
+        rate (float): ticks per second, 10-200 Hz
+        policy (str): what to do after an overrun (a tick started more
+            than one period late). 'skip' drops the missed deadlines and
+            stays on the original grid; 'catchup' runs them back to back.
+        clock: provides monotonic_ns() and sleep(), default the time
+            module (imclab_sim.SimClock for simulated time)
+    """
+
+    def __init__(self, rate=10, policy='skip', clock=time):
+        if not 10 <= rate <= 200:
+            raise ValueError('rate must be between 10 and 200 Hz')
+        if policy not in ('skip', 'catchup'):
+            raise ValueError("policy must be 'skip' or 'catchup'")
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.policy = policy
+        self.clock = clock
+        self._period_ns = int(round(1e9 / rate))
+        self.start()
+
+    def start(self):
+        """(Re)start the schedule; the first tick is one period from now."""
+        now = self.clock.monotonic_ns()
+        self._last = now
+        self._next = now + self._period_ns
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self._late_sum = 0
+        self._late_sq = 0
+        self._late_max = 0
+
+    def wait(self):
+        """Sleep until the next deadline, return seconds since the last tick."""
+        now = self.clock.monotonic_ns()
+        if now < self._next:
+            self.clock.sleep((self._next - now) / 1e9)
+            now = self.clock.monotonic_ns()
+        late = max(0, now - self._next)
+        self.ticks += 1
+        self._late_sum += late
+        self._late_sq += late * late
+        self._late_max = max(self._late_max, late)
+        if late >= self._period_ns:
+            self.overruns += 1
+            missed = late // self._period_ns
+            if self.policy == 'skip':
+                self.skipped += missed
+                self._next += missed * self._period_ns
+        self._next += self._period_ns
+        dt = (now - self._last) / 1e9
+        self._last = now
+        return dt
+
+    def __iter__(self):
+        while True:
+            yield self.wait()
+
+    def stats(self):
+        """Tick count, overruns, skipped deadlines and wake-up jitter (ms)."""
+        n = max(1, self.ticks)
+        mean = self._late_sum / n
+        var = max(0.0, self._late_sq / n - mean * mean)
+        return {'rate': self.rate, 'ticks': self.ticks,
+                'overruns': self.overruns, 'skipped': self.skipped,
+                'jitter_mean_ms': mean / 1e6, 'jitter_std_ms': var ** 0.5 / 1e6,
+                'jitter_max_ms': self._late_max / 1e6}
+
+class RingBuffer(object):
+    """
+    Fixed-capacity ring buffer of structured NumPy records.
+
+    Every record is stored twice, at i and i + capacity, so the newest
+    n records (n <= capacity) always form one contiguous slice and can
+    be handed out as a view without copying. Appending is O(1).
+
+    One thread appends; any number of threads may call snapshot() at
+    the same time. The counters live in an int64 header (record count
+    and a sequence number that is odd while a write is in progress), so
+    readers detect a torn copy and retry instead of taking a lock, and
+    the writer never waits for them.
+
+    Input:
+        capacity (int): records retained
+        dtype: record dtype, default SAMPLE_DTYPE
+        buffer: zero-filled memory of nbytes(capacity, dtype) bytes to
+            place the header and records in, e.g. the buf of a
+            multiprocessing.shared_memory block so that another process
+            can attach to the same ring. Default: private memory.
+    """
+
+    def __init__(self, capacity, dtype=SAMPLE_DTYPE, buffer=None):
+        self.capacity = int(capacity)
+        if buffer is None:
+            buffer = bytearray(self.nbytes(capacity, dtype))
+        # count, sequence
+        self.header = np.ndarray(2, dtype=np.int64, buffer=buffer)
+        self.data = np.ndarray(2*self.capacity, dtype=dtype, buffer=buffer,
+                               offset=self.header.nbytes)
+
+    @staticmethod
+    def nbytes(capacity, dtype=SAMPLE_DTYPE):
+        """Bytes of memory a ring of `capacity` records needs."""
+        return 16 + 2*int(capacity)*np.dtype(dtype).itemsize
+
+    @property
+    def count(self):
+        return int(self.header[0])
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, *values):
+        header = self.header
+        header[1] += 1                 # odd: write in progress
+        i = header[0] % self.capacity
+        self.data[i] = values
+        self.data[i+self.capacity] = values
+        header[0] += 1
+        header[1] += 1                 # even: consistent again
+
+    def latest(self):
+        return self.data[(self.count-1) % self.capacity]
+
+    def clear(self):
+        self.header[1] += 1
+        self.header[0] = 0
+        self.header[1] += 1
+
+    def view(self, since=None):
+        """
+        Return the records appended after the first `since` ones.
+
+        With since=None all retained records are returned. Records that
+        were already overwritten are skipped. The result is a view into
+        the buffer and stays valid until `capacity` more records arrive.
+        """
+        count = self.count
+        start = count - min(count, self.capacity)
+        if since is not None:
+            start = max(start, min(since, count))
+        i = start % self.capacity
+        return self.data[i:i+count-start]
+
+    def snapshot(self, since=None):
+        """
+        Consistent copy of view(since), safe to take from another thread
+        (or process) while records are appended. The copy is retried if
+        a write overlapped it.
+        """
+        return self.read(since)[0]
+
+    def read(self, since=None):
+        """
+        Like snapshot(), but also return the record count the copy ends
+        at; pass it as `since` next time to receive only newer records.
+        """
+        while True:
+            seq = int(self.header[1])
+            if not seq & 1:
+                count = self.count
+                data = self.view(since).copy()
+                if int(self.header[1]) == seq:
+                    return data, count
+            time.sleep(0)
+
 class iMCLab(object):
 
-    def __init__(self, port=None, baud=115200):
-        port = self.findPort()
+    def __init__(self, port=None, baud=115200, protocol='auto',
+                 serial_number=None, timeout=10, on_stats=None):
+        """
+        Connect to the iMCLab firmware.
+
+        Without an explicit port the last good port from the port cache
+        is tried first, then all matching boards are probed in parallel.
+        The connection is ready as soon as the firmware answers VER.
+
+        Input:
+            port (str): serial port to use, skips discovery. Defaults
+                to the IMCLAB_PORT environment variable when set.
+            protocol (str): 'ascii', 'binary' or 'auto'. With 'auto' the
+                binary framing is used when the firmware supports it
+                and ASCII otherwise.
+            serial_number (str): only accept the board with this USB
+                serial number
+            timeout (float): seconds to wait for the firmware to answer
+            on_stats (callable): called as on_stats(cmd, rtt, status)
+                after every exchange, see stats()
+        """
         print('Opening connection')
-        self.sp = serial.Serial(port=port, baudrate=baud, timeout=2)
-        self.sp.flushInput()
-        self.sp.flushOutput()
-        time.sleep(3)
-        print('iMCLab connected via Arduino on port ' + port)
+        self._stats = DriverStats(on_stats)
+        self.sp, self._version = self._open(port, baud, serial_number, timeout)
+        self.timeout = 2     # default reply timeout, see read()
+        self.sp.timeout = self.timeout
+        self.missed = 0      # RPM requests that returned no fresh sample
+        self._resync = False
+        self.binary = False
+        self._tx = bytearray(FRAME.size)
+        self._rx = bytearray(FRAME.size)
+        self._streaming = False
+        self.stream_error = None  # why the reader stopped on its own
+        self.buffer = None
+        self._negotiate(protocol)
+        print('iMCLab connected via Arduino on port ' + self.sp.port)
+
+    def _open(self, port, baud, serial_number, timeout):
+        if port is None:
+            port = os.environ.get('IMCLAB_PORT')  # e.g. the imclab_sim pty
+        if port is not None:
+            r = probe(port, baud, timeout)
+            if r is None:
+                raise IOError('No answer from iMCLab firmware on ' + port)
+            return r
+        cached = load_port_cache().get(serial_number or '_last')
+        candidates = find_ports(serial_number)
+        devices = [p.device for p in candidates]
+        if cached and (cached in devices or not devices):
+            # fast path: the board is usually still on the same port, and
+            # trying it first avoids resetting every other board on the bus
+            r = probe(cached, baud, min(timeout, CACHE_PROBE_TIMEOUT))
+            if r is not None:
+                save_port_cache(cached, serial_number)
+                return r
+            if cached in devices:
+                devices.remove(cached)
+        r = probe_ports(devices, baud, timeout)
+        if r is None:
+            if serial_number is not None:
+                raise IOError('iMCLab with serial number %s not found' % serial_number)
+            r = probe(ask_port(), baud, timeout)
+            if r is None:
+                raise IOError('No answer from iMCLab firmware')
+        sn = dict((p.device, p.serial_number) for p in candidates).get(r[0].port)
+        save_port_cache(r[0].port, sn)
+        return r
+
+    def stats(self):
+        """
+        Round-trip histograms, timeout, garbled-reply and byte counts
+        per command since connect or the last reset_stats().
+        """
+        return self._stats.snapshot()
+
+    def reset_stats(self):
+        self._stats.reset()
+
+    def _negotiate(self,protocol):
+        if protocol == 'ascii':
+            return
+        if parse_version(self._version) >= BINARY_MIN_VERSION:
+            if self.write('BIN',1) == 'BIN':
+                self.binary = True
+                return
+        if protocol == 'binary':
+            raise IOError('Binary protocol not supported by firmware: ' \
+                          + str(self._version))
         
     def findPort(self):
-        found = False
-        for port in list(list_ports.comports()):
-            # Arduino Uno
-            if port[2].startswith('USB VID:PID=16D0:0613'):
-                port = port[0]
-                found = True
-            # Arduino HDuino
-            if port[2].startswith('USB VID:PID=1A86:7523'):
-                port = port[0]
-                found = True                
-            # Arduino Leonardo
-            if port[2].startswith('USB VID:PID=2341:8036'):
-                port = port[0]
-                found = True
-            # Arduino ESP32
-            if port[2].startswith('USB VID:PID=10C4:EA60'):
-                port = port[0]
-                found = True
-            # Arduino ESP32 - Tipe yg berbeda
-            if port[2].startswith('USB VID:PID=1A86:55D4'):
-                port = port[0]
-                found = True
-        if (not found):
-            print('Arduino COM port not found')
-            print('Please ensure that the USB cable is connected')
-            print('--- Printing Serial Ports ---')            
-            for port in list(serial.tools.list_ports.comports()):
-                print(port[0] + ' ' + port[1] + ' ' + port[2])
-            print('For Windows:')
-            print('  Open device manager, select "Ports (COM & LPT)"')
-            print('  Look for COM port of Arduino such as COM4')
-            print('For MacOS:')
-            print('  Open terminal and type: ls /dev/*.')
-            print('  Search for /dev/tty.usbmodem* or /dev/tty.usbserial*. The port number is *.')
-            print('For Linux')
-            print('  Open terminal and type: ls /dev/tty*')
-            print('  Search for /dev/ttyUSB* or /dev/ttyACM*. The port number is *.')
-            print('')
-            port = input('Input port: ')
-            # or hard-code it here
-            #port = 'COM3' # for Windows
-            #port = '/dev/tty.wchusbserial1410' # for MacOS
-        return port
+        ports = find_ports()
+        if ports:
+            return ports[0].device
+        return ask_port()
     
     def stop(self):
         return self.read('X')
     
     def version(self):
+        if self.binary:
+            return self._version
         return self.read('VER')
     
     @property
     def RPM(self):
+        if self._streaming and self.buffer.count:
+            # latest pushed sample, no serial exchange
+            self._RPM = float(self.buffer.latest()['rpm'])
+            return self._RPM
         self._RPM = float(self.read('RPM'))
         return self._RPM
+
+    def read_rpm(self,timeout=None):
+        """
+        Read the RPM, waiting at most `timeout` seconds for the reply.
+
+        Unlike RPM this never raises: it returns None when no fresh
+        sample arrived in time (counted in missed), so a control loop
+        can hold its last value instead of acting on a bogus reading.
+        """
+        if self._streaming and self.buffer.count:
+            self._RPM = float(self.buffer.latest()['rpm'])
+            return self._RPM
+        return self._sample(self.read('RPM',timeout))
+
+    def _sample(self,reply):
+        try:
+            self._RPM = float(reply)
+        except (TypeError, ValueError):
+            self.missed += 1
+            return None
+        return self._RPM
+
+    def start_stream(self,rate=50,capacity=4096):
+        """
+        Let the firmware push timestamped RPM samples at a fixed rate.
+
+        A reader thread decodes the pushed frames into a preallocated
+        RingBuffer, so RPM returns the latest sample immediately and
+        samples() hands out new samples without copying. Commands keep
+        working; their replies are routed back through the reader.
+        Requires the binary protocol and firmware 1.3+. If the port
+        fails the reader stops and keeps the exception in stream_error.
+
+        Input:
+            rate (float): push rate in Hz (1-200)
+            capacity (int): number of samples kept in the ring buffer
+        """
+        if not self.binary or parse_version(self._version) < STREAM_MIN_VERSION:
+            raise IOError('Streaming needs binary protocol and firmware 1.3+')
+        if self._streaming:
+            return
+        self.buffer = RingBuffer(capacity)
+        self._replies = queue.Queue()
+        # short port timeout so the reader notices stop_stream() quickly
+        self.sp.timeout = 0.1
+        self.stream_error = None
+        self._streaming = True
+        self._reader = threading.Thread(target=self._read_stream,daemon=True)
+        self._reader.start()
+        if not self.exchange_frame('STREAM',rate):
+            self.stop_stream()
+            raise IOError('Firmware refused to start streaming')
+
+    def stop_stream(self):
+        if not self._streaming:
+            return
+        self.exchange_frame('STREAM',0)
+        self._streaming = False
+        self._reader.join()
+        self.sp.timeout = self.timeout
+
+    def samples(self,since=None):
+        """
+        Return the streamed samples after the first `since` ones as a
+        zero-copy view with fields 't' (device seconds) and 'rpm'.
+        Use buffer.count as the cursor for the next call.
+        """
+        return self.buffer.view(since)
+
+    def _read_stream(self):
+        head = bytearray(1)
+        frame = bytearray(FRAME.size)
+        telem = bytearray(TELEMETRY.size)
+        wrap = 0
+        last_ms = 0
+        while self._streaming:
+            try:
+                if self.sp.readinto(head) != 1:
+                    continue
+                if head[0] == TSYNC:
+                    buf = telem
+                elif head[0] == SYNC:
+                    buf = frame
+                else:
+                    continue  # resync on the next sync byte
+                buf[0] = head[0]
+                n = self.sp.readinto(memoryview(buf)[1:])
+            except (serial.SerialException, OSError) as e:
+                # port gone, e.g. USB cable unplugged: stop instead of
+                # spinning; RPM falls back to (failing) requests
+                self.stream_error = e
+                self._streaming = False
+                break
+            if buf is telem:
+                # pushed frames have no request: count size and integrity only
+                self._stats.pushed(n+1,n == len(buf)-1 and buf[-1] == checksum(buf))
+            if n != len(buf)-1 or buf[-1] != checksum(buf):
+                continue
+            if buf is telem:
+                _, ms, rpm, _ = TELEMETRY.unpack_from(telem)
+                if ms < last_ms:
+                    wrap += 1 << 32  # millis() rolled over
+                last_ms = ms
+                self.buffer.append((wrap+ms)/1000.0, rpm)
+            else:
+                self._replies.put(FRAME.unpack_from(frame)[1:3])
             
     def LED(self,pwm):
         pwm = max(0.0,min(100.0,pwm))/2.0
@@ -85,12 +860,31 @@ class iMCLab(object):
         pwm = max(0.0,min(100.0,pwm)) 
         self.write('op',pwm)
         return pwm
+
+    def step(self,pwm,timeout=None):
+        """
+        Set the motor output and read the RPM in a single exchange.
+
+        Replaces an op() + RPM pair with one request/response, halving
+        the serial round trips per control tick. Requires firmware 1.1+.
+
+        Input:
+            pwm (float): motor output in percent (0-100)
+            timeout (float): seconds to wait for the reply, e.g. part of
+                the control period; default is the driver timeout
+        Output:
+            RPM reported by the firmware after the output was applied,
+            or None if no fresh sample arrived in time (see read_rpm)
+        """
+        pwm = max(0.0,min(100.0,pwm))
+        return self._sample(self.write('STEP',pwm,timeout))
         
     # save txt file with data and set point
     # t = time
     # u = Output Controller
     # y = RPM
     # sp = setpoints
+    # (for long runs log with ChunkedLog while the loop runs instead)
     def save_txt(self,t,u,y,sp):
         data = np.vstack((t,u,y,sp))  # vertical stack
         data = data.T                 # transpose data
@@ -99,23 +893,67 @@ class iMCLab(object):
           + 'Set Point (rpm)' 
         np.savetxt('data.txt',data,delimiter=',',header=top,comments='')
 
-    def read(self,cmd):
-        cmd_str = self.build_cmd_str(cmd,'')
+    def read(self,cmd,timeout=None):
+        """
+        Send a command and return its reply. `timeout` bounds the wait
+        for this call only; None uses the driver timeout.
+        """
+        if self.binary:
+            return self.exchange_frame(cmd,0.0,timeout)
+        return self.exchange_line(cmd,self.build_cmd_str(cmd,''),timeout)
+    
+    def write(self,cmd,pwm,timeout=None):       
+        if self.binary:
+            return self.exchange_frame(cmd,pwm,timeout)
+        return self.exchange_line(cmd,self.build_cmd_str(cmd,(pwm,)),timeout)
+
+    def _set_timeout(self,timeout):
+        timeout = self.timeout if timeout is None else timeout
+        if self.sp.timeout != timeout:
+            self.sp.timeout = timeout
+
+    def exchange_line(self,cmd,cmd_str,timeout=None):
+        """
+        Send one ASCII command line and return the reply line.
+
+        After a timed-out exchange the line stream is resynchronized:
+        input left over from the late reply is discarded before the next
+        command, and a stale line that slips in is skipped.
+        """
+        start = time.perf_counter()
+        data = cmd_str.encode()
+        if self._resync:
+            self.sp.reset_input_buffer()
         try:
-            self.sp.write(cmd_str.encode())
+            self.sp.write(data)
             self.sp.flush()
         except Exception:
+            self._stats.record(cmd.upper(),start,0,0,'error')
             return None
-        return self.sp.readline().decode('UTF-8').replace("\r\n", "")
-    
-    def write(self,cmd,pwm):       
-        cmd_str = self.build_cmd_str(cmd,(pwm,))
+        self._set_timeout(timeout)
+        raw = self.sp.readline()
+        if self._resync and raw.endswith(b'\n') and self.sp.in_waiting:
+            # that was the late reply; ours is queued right behind it
+            raw = self.sp.readline()
+        self._resync = not raw.endswith(b'\n')
+        reply = raw.decode('UTF-8','replace').replace("\r\n", "")
+        if not raw.endswith(b'\n'):
+            status = 'timeout'
+        elif '\ufffd' in reply or not self._valid_reply(cmd,reply):
+            status = 'garbled'
+        else:
+            status = 'ok'
+        self._stats.record(cmd.upper(),start,len(data),len(raw),status)
+        return reply
+
+    def _valid_reply(self,cmd,reply):
+        if cmd.upper() not in NUMERIC_REPLIES:
+            return True
         try:
-            self.sp.write(cmd_str.encode())
-            self.sp.flush()
-        except:
-            return None
-        return self.sp.readline().decode('UTF-8').replace("\r\n", "")
+            float(reply)
+            return True
+        except ValueError:
+            return False
     
     def build_cmd_str(self,cmd, args=None):
         """
@@ -131,13 +969,397 @@ class iMCLab(object):
         else:
             args = ''
         return "{cmd} {args}\n".format(cmd=cmd, args=args)
+
+    def exchange_frame(self,cmd,value=0.0,timeout=None):
+        """
+        Send one binary frame and return the float payload of the reply.
+
+        Frames are packed into and parsed from reusable buffers, so no
+        strings are built per exchange. Returns None on a write error,
+        a timeout (reply not complete within `timeout` seconds) or a
+        reply that fails the sync/code/checksum check; the stream is
+        resynchronized before the next exchange.
+        """
+        start = time.perf_counter()
+        cmd = cmd.upper()
+        code = CMD_CODES[cmd]
+        FRAME.pack_into(self._tx,0,SYNC,code,value,0)
+        self._tx[-1] = checksum(self._tx)
+        if self._streaming:
+            # drop late replies left over from timed-out exchanges
+            while not self._replies.empty():
+                self._replies.get_nowait()
+        elif self._resync:
+            self.sp.reset_input_buffer()
+        try:
+            self.sp.write(self._tx)
+            self.sp.flush()
+        except Exception:
+            self._stats.record(cmd,start,0,0,'error')
+            return None
+        if self._streaming:
+            try:
+                rcode, payload = self._replies.get(
+                    timeout=self.timeout if timeout is None else timeout)
+            except queue.Empty:
+                self._stats.record(cmd,start,FRAME.size,0,'timeout')
+                return None
+            ok = rcode == code
+            self._stats.record(cmd,start,FRAME.size,FRAME.size,
+                               'ok' if ok else 'garbled')
+            return payload if ok else None
+        self._set_timeout(timeout)
+        n = self.sp.readinto(self._rx)
+        if n == FRAME.size and self._resync and self.sp.in_waiting >= FRAME.size:
+            # that was the late reply; ours is queued right behind it
+            n = self.sp.readinto(self._rx)
+        self._resync = True
+        if n != FRAME.size:
+            self._stats.record(cmd,start,FRAME.size,n,'timeout')
+            return None
+        sync, rcode, payload, chk = FRAME.unpack_from(self._rx)
+        if sync != SYNC or rcode != code or chk != checksum(self._rx):
+            self._stats.record(cmd,start,FRAME.size,n,'garbled')
+            return None
+        self._resync = False
+        self._stats.record(cmd,start,FRAME.size,n,'ok')
+        return payload
         
     def close(self):
         try:
+            self.stop_stream()
+            if self.binary:
+                # leave the firmware in ASCII mode for the next session
+                self.exchange_frame('BIN',0)
+                self.binary = False
             self.sp.close()
             print('Arduino disconnected successfully')
         except:
             print('Problems disconnecting from Arduino.')
             print('Please unplug and reconnect Arduino.')
         return True
-    
+
+
+class DevicePool(object):
+    """
+    Drive several iMCLab boards from one process.
+
+    Every matching board (or every port in `ports`) gets its own iMCLab
+    instance and its own worker thread. start(target) runs
+    target(name, lab) on each worker, so independent control loops run
+    side by side. Workers call publish(name, ...) to report telemetry,
+    which is tagged with the board name and collected in one queue.
+
+        pool = DevicePool()
+        pool.start(loop)        # loop(name, lab) runs while pool.running
+        while not pool.join(0.5):
+            print(pool.drain())
+        pool.close()
+    """
+
+    def __init__(self, ports=None, baud=115200, protocol='auto', timeout=10):
+        found = find_ports()
+        names = dict((p.device, p.serial_number or p.device) for p in found)
+        if ports is None:
+            ports = [p.device for p in found]
+        if not ports:
+            raise IOError('No iMCLab boards found')
+        self.labs = {}
+        self.telemetry = queue.Queue()
+        self.running = False
+        self._workers = {}
+        # boards are opened in parallel, each waits for its own firmware
+        with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+            futures = dict((pool.submit(iMCLab, port, baud, protocol, None, timeout), port)
+                           for port in ports)
+            for f in as_completed(futures):
+                port = futures[f]
+                try:
+                    self.labs[names.get(port, port)] = f.result()
+                except Exception as e:
+                    print('Skipping ' + port + ': ' + str(e))
+        if not self.labs:
+            raise IOError('No iMCLab board answered')
+
+    def __len__(self):
+        return len(self.labs)
+
+    def __iter__(self):
+        return iter(sorted(self.labs.items()))
+
+    def __getitem__(self, name):
+        return self.labs[name]
+
+    def start(self, target):
+        self.running = True
+        for name, lab in self:
+            t = threading.Thread(target=self._run, args=(target, name, lab),
+                                 name='imclab-' + name, daemon=True)
+            self._workers[name] = t
+            t.start()
+
+    def _run(self, target, name, lab):
+        try:
+            target(name, lab)
+        except Exception as e:
+            self.publish(name, error=str(e))
+        finally:
+            try:
+                lab.op(0)
+            except Exception:
+                pass
+
+    def publish(self, name, **fields):
+        """Queue one telemetry record tagged with the board name."""
+        fields['device'] = name
+        fields.setdefault('t', time.time())
+        self.telemetry.put(fields)
+
+    def drain(self):
+        """Return all queued telemetry records."""
+        records = []
+        while True:
+            try:
+                records.append(self.telemetry.get_nowait())
+            except queue.Empty:
+                return records
+
+    def join(self, timeout=None):
+        """
+        Wait up to `timeout` seconds (None: no limit) for the workers
+        to return. True once all of them have finished.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for t in list(self._workers.values()):
+            t.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        return not any(t.is_alive() for t in self._workers.values())
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self._workers = {}
+
+    def close(self):
+        self.stop()
+        for name, lab in self:
+            lab.op(0)
+            lab.close()
+        return True
+
+class AsyncIMCLab(object):
+    """
+    asyncio version of iMCLab built on a non-blocking serial transport.
+
+    Offers the same command set (RPM, OP, STEP, LED, VER, X) and the same
+    ASCII/binary negotiation as iMCLab, so one event loop can run the
+    control loop, MQTT I/O and several rigs together without threads.
+    The port is found and probed as by iMCLab, in a worker thread.
+    Needs the pyserial-asyncio package.
+
+        lab = await AsyncIMCLab.open()
+        rpm = await lab.step(40)
+        await lab.close()
+    """
+
+    _open = iMCLab._open
+    build_cmd_str = iMCLab.build_cmd_str
+    stats = iMCLab.stats
+    reset_stats = iMCLab.reset_stats
+    _valid_reply = iMCLab._valid_reply
+
+    def __init__(self, port=None, baud=115200, protocol='auto', timeout=2,
+                 on_stats=None, serial_number=None):
+        self._stats = DriverStats(on_stats)
+        self.missed = 0
+        self.port = port
+        self.serial_number = serial_number
+        self.baud = baud
+        self.protocol = protocol
+        self.timeout = timeout
+        self.binary = False
+        self._version = None
+        self._tx = bytearray(FRAME.size)
+        self._reader = None
+        self._writer = None
+        self._lock = None
+        self._pending = []   # commands whose late replies may still arrive
+
+    @classmethod
+    async def open(cls, *args, **kwargs):
+        lab = cls(*args, **kwargs)
+        await lab.connect()
+        return lab
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def connect(self):
+        try:
+            import serial_asyncio
+        except ImportError:
+            raise ImportError('AsyncIMCLab needs pyserial-asyncio: '
+                              'pip install pyserial-asyncio')
+        print('Opening connection')
+        # same discovery as iMCLab (port cache, parallel probing, BIN 0
+        # reset, VER polling), in a worker thread so the loop keeps running
+        loop = asyncio.get_running_loop()
+        sp, self._version = await loop.run_in_executor(
+            None, self._open, self.port, self.baud, self.serial_number, 10)
+        self.port = sp.port
+        # keep the probed port open: reopening would reset an Uno again
+        self._reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(self._reader)
+        transport, _ = await serial_asyncio.connection_for_serial(
+            loop, lambda: protocol, sp)
+        self._writer = asyncio.StreamWriter(transport, protocol, self._reader, loop)
+        self._lock = asyncio.Lock()
+        if self.protocol != 'ascii':
+            if parse_version(self._version) >= BINARY_MIN_VERSION \
+                    and await self.write('BIN',1) == 'BIN':
+                self.binary = True
+            elif self.protocol == 'binary':
+                raise IOError('Binary protocol not supported by firmware: ' \
+                              + str(self._version))
+        print('iMCLab connected via Arduino on port ' + self.port)
+
+    _sample = iMCLab._sample
+
+    async def read_rpm(self,timeout=None):
+        """RPM, or None if no fresh sample arrived within `timeout`."""
+        return self._sample(await self.read('RPM',timeout))
+
+    async def set_op(self,pwm):
+        pwm = max(0.0,min(100.0,pwm))
+        await self.write('op',pwm)
+        return pwm
+
+    async def step(self,pwm,timeout=None):
+        pwm = max(0.0,min(100.0,pwm))
+        return self._sample(await self.write('STEP',pwm,timeout))
+
+    async def LED(self,pwm):
+        pwm = max(0.0,min(100.0,pwm))/2.0
+        await self.write('LED',pwm)
+        return pwm
+
+    async def stop(self):
+        return await self.read('X')
+
+    async def version(self):
+        if self.binary:
+            return self._version
+        return await self.read('VER')
+
+    async def read(self,cmd,timeout=None):
+        if self.binary:
+            return await self.exchange_frame(cmd,0.0,timeout)
+        return await self._exchange_line(self.build_cmd_str(cmd,''),timeout)
+
+    async def write(self,cmd,pwm,timeout=None):
+        if self.binary:
+            return await self.exchange_frame(cmd,pwm,timeout)
+        return await self._exchange_line(self.build_cmd_str(cmd,(pwm,)),timeout)
+
+    async def _receive(self,cmd,read,deadline,code_of=None):
+        """
+        Read the reply to `cmd`, skipping late replies of timed-out
+        exchanges. The firmware answers in order, so a late reply comes
+        before ours. A reply whose command code (`code_of(reply)`, binary
+        frames only) is not ours is skipped; otherwise, while a late
+        reply is pending, a reply followed by another one before
+        `deadline` was the late one.
+        """
+        loop = asyncio.get_running_loop()
+        reply = await asyncio.wait_for(read(),deadline - loop.time())
+        while self._pending:
+            code = code_of(reply) if code_of else None
+            if code is not None and code != cmd:
+                if code in self._pending:
+                    self._pending.remove(code)
+                reply = await asyncio.wait_for(read(),deadline - loop.time())
+                continue
+            if code is not None and cmd not in self._pending:
+                break   # the pending replies were lost, this one is ours
+            try:
+                later = await asyncio.wait_for(read(),deadline - loop.time())
+            except asyncio.TimeoutError:
+                break   # the late reply was lost, this one is ours
+            self._pending.pop(0)
+            reply = later
+        del self._pending[:]
+        return reply
+
+    async def _exchange_line(self,cmd_str,timeout=None):
+        cmd = cmd_str.split()[0].upper()
+        data = cmd_str.encode()
+        async with self._lock:
+            start = time.perf_counter()
+            deadline = asyncio.get_running_loop().time() + (timeout or self.timeout)
+            try:
+                self._writer.write(data)
+                await self._writer.drain()
+            except Exception:
+                self._stats.record(cmd,start,0,0,'error')
+                return None
+            try:
+                line = await self._receive(cmd,self._reader.readline,deadline)
+            except asyncio.TimeoutError:
+                self._pending.append(cmd)  # its reply may still arrive
+                self._stats.record(cmd,start,len(data),0,'timeout')
+                return None
+            except Exception:
+                self._stats.record(cmd,start,len(data),0,'timeout')
+                return None
+        reply = line.decode('UTF-8','replace').replace("\r\n", "")
+        status = 'ok'
+        if '\ufffd' in reply or not self._valid_reply(cmd,reply):
+            status = 'garbled'
+        self._stats.record(cmd,start,len(data),len(line),status)
+        return reply
+
+    async def exchange_frame(self,cmd,value=0.0,timeout=None):
+        cmd = cmd.upper()
+        code = CMD_CODES[cmd]
+        async with self._lock:
+            start = time.perf_counter()
+            deadline = asyncio.get_running_loop().time() + (timeout or self.timeout)
+            FRAME.pack_into(self._tx,0,SYNC,code,value,0)
+            self._tx[-1] = checksum(self._tx)
+            try:
+                self._writer.write(self._tx)
+                await self._writer.drain()
+            except Exception:
+                self._stats.record(cmd,start,0,0,'error')
+                return None
+            try:
+                rx = await self._receive(code,lambda: self._reader.readexactly(FRAME.size),
+                                         deadline,lambda rx: rx[1])
+            except asyncio.TimeoutError:
+                self._pending.append(code)
+                self._stats.record(cmd,start,FRAME.size,0,'timeout')
+                return None
+            except Exception:
+                self._stats.record(cmd,start,FRAME.size,0,'timeout')
+                return None
+        sync, rcode, payload, chk = FRAME.unpack(rx)
+        if sync != SYNC or rcode != code or chk != checksum(rx):
+            self._stats.record(cmd,start,FRAME.size,len(rx),'garbled')
+            return None
+        self._stats.record(cmd,start,FRAME.size,len(rx),'ok')
+        return payload
+
+    async def close(self):
+        try:
+            if self.binary:
+                await self.exchange_frame('BIN',0)
+                self.binary = False
+            self._writer.close()
+            print('Arduino disconnected successfully')
+        except:
+            print('Problems disconnecting from Arduino.')
+            print('Please unplug and reconnect Arduino.')
+        return True
@@ -0,0 +1,454 @@
+"""
+Headless iMCLab motor controller.
+
+ControllerEngine holds the control law shared by the apps and the data
+collector: the 0.7/0.3 RPM filter, PID, anti-windup, the dynamic floor
+and the start-up kick. It has no Tk or matplotlib dependency, so it
+also runs as a daemon on a lab server, at rates up to 200 Hz:
+
+    python controller_engine.py --sp 3000 --rate 50
+    python controller_engine.py --sp 3000 --all          # every connected rig
+    python controller_engine.py --sp 3000 --port COM3 --port COM4
+    python controller_engine.py --sp 3000 --classic --kp 1.5 --ki 0.5 --kd 0.05
+    python controller_engine.py --sp 3000 --virtual --duration 30
+
+EngineProcess runs the engine and the serial driver in a process of
+their own, so the loop timing does not depend on GUI or ML load.
+"""
+import sys
+import time
+import queue
+import argparse
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import imclab
+
+# Dynamic floor: lowest PWM (%) that keeps the motor turning, per setpoint tier
+FLOOR_TIERS = ((2200, 65.0), (3500, 60.0), (4500, 57.0))
+FLOOR_TOP = 55.0
+KICK_POWER = 83.0   # PWM (%) that breaks a stalled motor loose
+RPM_ALIVE = 500     # below this speed (rpm) the motor counts as stalled
+
+HYBRID_GAINS = (0.005, 0.005, 0.002)
+CLASSIC_GAINS = (1.5, 0.5, 0.05)
+
+# one record per control tick as published by EngineProcess
+TICK_DTYPE = np.dtype([('t', 'f8'), ('sp', 'f4'), ('pv', 'f4'), ('op', 'f4'),
+                       ('rpm', 'f4'), ('floor', 'f4')])
+
+def dynamic_floor(setpoint):
+    """Lowest running PWM (%) for a setpoint (rpm)."""
+    for limit, floor in FLOOR_TIERS:
+        if setpoint < limit:
+            return floor
+    return FLOOR_TOP
+
+class ControllerEngine(object):
+    """
+    PID controller for one iMCLab motor, free of any UI.
+
+    update() computes one control step; run() drives a board on an
+    imclab.Scheduler with one step() transaction per tick. setpoint and
+    the gains may be changed from other threads while run() is active.
+
+    Input:
+        kp, ki, kd (float): PID gains
+        setpoint (float): target speed (rpm)
+        hybrid (bool): True for the AI apps and the collector: filtered
+            RPM, derivative on measurement, conditional integration,
+            dynamic floor and kick. False for the classic PID of
+            pid_python.py: raw RPM, derivative on error and the
+            integral clamped to +-100.
+    """
+
+    def __init__(self, kp=None, ki=None, kd=None, setpoint=0.0, hybrid=True):
+        default = HYBRID_GAINS if hybrid else CLASSIC_GAINS
+        self.kp = default[0] if kp is None else kp
+        self.ki = default[1] if ki is None else ki
+        self.kd = default[2] if kd is None else kd
+        self.setpoint = setpoint
+        self.hybrid = hybrid
+        self.running = False
+        self.sched = None
+        self.reset()
+
+    def set_gains(self, kp, ki, kd):
+        self.kp, self.ki, self.kd = kp, ki, kd
+
+    def reset(self):
+        """Clear the filter, integral and derivative history."""
+        self.integral = 0.0
+        self.prev_pv = 0.0
+        self.prev_error = 0.0
+        self.rpm_filtered = 0.0
+        self.rpm = 0.0        # last measured speed
+        self.pv = 0.0         # speed the controller acted on
+        self.error = 0.0
+        self.floor = 0.0
+        self.op = 0.0
+        self.fresh = True
+        self.elapsed = 0.0    # seconds since run() started
+
+    def update(self, rpm, dt, fresh=True):
+        """
+        One control step.
+
+        Input:
+            rpm (float): measured speed; the held last value if not fresh
+            dt (float): seconds since the previous step
+            fresh (bool): False when no new sample arrived; the filter
+                and the integral are then left unchanged
+        Output:
+            op (float): motor output (%)
+        """
+        self.rpm = rpm
+        self.fresh = fresh
+        if self.hybrid:
+            self.op = self._hybrid(rpm, dt, fresh)
+        else:
+            self.op = self._classic(rpm, dt, fresh)
+        return self.op
+
+    def _classic(self, rpm, dt, fresh):
+        self.pv = rpm
+        error = self.error = self.setpoint - rpm
+        P = self.kp * error
+        # I (hanya diperbarui bila sampel RPM segar)
+        if fresh:
+            self.integral += error * dt
+            self.integral = max(-100, min(100, self.integral)) # Anti-windup
+        I = self.ki * self.integral
+        D = self.kd * (error - self.prev_error) / dt if dt > 0 else 0
+        self.prev_error = error
+        return max(0.0, min(100.0, P + I + D))
+
+    def _hybrid(self, rpm, dt, fresh):
+        if fresh:
+            self.rpm_filtered = (0.7 * self.rpm_filtered) + (0.3 * rpm)
+        pv = self.pv = self.rpm_filtered
+        error = self.error = self.setpoint - pv
+        P = self.kp * error
+        potential_integral = self.integral + (error * dt)
+        d_rpm = (pv - self.prev_pv) / dt if dt > 0 else 0
+        D = -self.kd * d_rpm
+        self.floor = dynamic_floor(self.setpoint)
+
+        # Integral ditahan bila saturasi atau sampel RPM tidak segar
+        op_temp = P + (self.ki * potential_integral) + D
+        if fresh and not (op_temp > 100.0 or (op_temp < self.floor and error < 0)):
+            self.integral = potential_integral
+        op = P + (self.ki * self.integral) + D
+
+        # Kick saat motor macet, selain itu jaga di atas floor
+        if pv < RPM_ALIVE and op > 1.0:
+            op = max(op, KICK_POWER)
+        elif op > 1.0:
+            op = max(op, self.floor)
+        self.prev_pv = pv
+        return max(0.0, min(100.0, op))
+
+    def run(self, lab, rate=10, duration=None, on_tick=None, clock=time):
+        """
+        Control `lab` until stop() or for `duration` seconds.
+
+        Input:
+            lab: iMCLab (or VirtualIMCLab) instance
+            rate (float): control rate, 10-200 Hz
+            duration (float): seconds to run, None for no limit
+            on_tick: callable(engine) called after every tick
+            clock: time source for the scheduler, default the time module
+        Output:
+            stats (dict): scheduler statistics
+        """
+        self.sched = imclab.Scheduler(rate=rate, clock=clock)
+        # Batas waktu balasan serial per tick (setengah periode loop)
+        read_timeout = 0.5 * self.sched.period
+        # STEP ada sejak firmware 1.1; firmware lama: OP lalu RPM tiap tick
+        version = getattr(lab, '_version', None)
+        combined = imclab.parse_version(version) >= imclab.STEP_MIN_VERSION
+        if not combined:
+            print('Warning: firmware %r has no STEP command, using OP + RPM per tick'
+                  % version)
+        # RPM awal; selanjutnya didapat dari balasan step() tiap tick
+        rpm = lab.read_rpm(timeout=read_timeout) or 0.0
+        fresh = True
+        start = clock.monotonic()
+        self.running = True
+        try:
+            while self.running:
+                dt = self.sched.wait()
+                self.elapsed = clock.monotonic() - start
+                if duration is not None and self.elapsed >= duration:
+                    break
+                op = self.update(rpm, dt, fresh)
+                if combined:
+                    # Kirim output + baca RPM baru dalam satu transaksi serial
+                    next_rpm = lab.step(op, timeout=read_timeout)
+                else:
+                    lab.op(op)
+                    next_rpm = lab.read_rpm(timeout=read_timeout)
+                if on_tick:
+                    on_tick(self)
+                # None = tidak ada sampel baru: tahan RPM terakhir
+                fresh = next_rpm is not None
+                if fresh:
+                    rpm = next_rpm
+        finally:
+            self.running = False
+        return self.sched.stats()
+
+    def stop(self):
+        self.running = False
+
+    def stats(self):
+        """Scheduler statistics of the last run(), {} before the first."""
+        return self.sched.stats() if self.sched else {}
+
+def _engine_process(shm_name, capacity, commands, events, port, rate,
+                    gains, setpoint, hybrid):
+    """Body of the EngineProcess child: own the board, run the engine."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    ring = imclab.RingBuffer(capacity, TICK_DTYPE, buffer=shm.buf)
+    try:
+        lab = imclab.iMCLab(port=port)
+    except Exception as e:
+        events.put(('error', str(e)))
+        ring.header = ring.data = None
+        shm.close()
+        return
+    engine = ControllerEngine(*gains, setpoint=setpoint, hybrid=hybrid)
+    events.put(('ready', lab.sp.port))
+
+    def on_tick(engine):
+        # commands are applied between ticks, never in the middle of one
+        while True:
+            try:
+                cmd, value = commands.get_nowait()
+            except queue.Empty:
+                break
+            if cmd == 'setpoint':
+                engine.setpoint = value
+            elif cmd == 'gains':
+                engine.set_gains(*value)
+            elif cmd == 'reset':
+                engine.reset()
+            elif cmd == 'stop':
+                engine.stop()
+        ring.append(time.monotonic(), engine.setpoint, engine.pv, engine.op,
+                    engine.rpm, engine.floor)
+
+    try:
+        engine.run(lab, rate=rate, on_tick=on_tick)
+    finally:
+        lab.op(0)
+        lab.close()
+        events.put(('stats', engine.stats()))
+        ring.header = ring.data = None   # drop the views before unmapping
+        shm.close()
+
+class EngineProcess(object):
+    """
+    ControllerEngine and iMCLab driver in a separate process.
+
+    Ticks are published into an imclab.RingBuffer placed in
+    multiprocessing.shared_memory (TICK_DTYPE records, time stamped with
+    time.monotonic()), which read() copies out without pickling or
+    locking. Setpoint, gain, reset and stop commands travel through a
+    multiprocessing.Queue and are applied between ticks. The setpoint,
+    set_gains(), reset(), stop() and stats() mirror ControllerEngine,
+    so an app can use either.
+
+        engine = EngineProcess(setpoint=3000, rate=50).start()
+        engine.setpoint = 2500
+        ticks = engine.read()      # records since the previous read()
+        engine.close()
+
+    Input:
+        kp, ki, kd, setpoint, hybrid: as for ControllerEngine
+        port (str): serial port, default discovery as in iMCLab
+        rate (float): control rate, 10-200 Hz
+        capacity (int): ticks buffered between two read() calls
+    """
+
+    def __init__(self, kp=None, ki=None, kd=None, setpoint=0.0, hybrid=True,
+                 port=None, rate=10, capacity=4096):
+        default = HYBRID_GAINS if hybrid else CLASSIC_GAINS
+        self.kp = default[0] if kp is None else kp
+        self.ki = default[1] if ki is None else ki
+        self.kd = default[2] if kd is None else kd
+        self._setpoint = setpoint
+        self.port = port
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=imclab.RingBuffer.nbytes(capacity, TICK_DTYPE))
+        self.ring = imclab.RingBuffer(capacity, TICK_DTYPE, buffer=self.shm.buf)
+        self.ring.header[:] = 0
+        self.commands = mp.Queue()
+        self.events = mp.Queue()
+        self.process = mp.Process(
+            target=_engine_process, name='imclab-engine', daemon=True,
+            args=(self.shm.name, capacity, self.commands, self.events, port,
+                  rate, (self.kp, self.ki, self.kd), setpoint, hybrid))
+        self._cursor = 0
+        self._stats = {}
+
+    def start(self, timeout=20):
+        """Start the process and wait until it has connected to the board."""
+        self.process.start()
+        try:
+            kind, value = self.events.get(timeout=timeout)
+        except queue.Empty:
+            kind, value = 'error', 'controller process did not answer'
+        if kind != 'ready':
+            self.close()
+            raise IOError(value)
+        self.port = value
+        return self
+
+    @property
+    def setpoint(self):
+        return self._setpoint
+
+    @setpoint.setter
+    def setpoint(self, value):
+        self._setpoint = value
+        self.commands.put(('setpoint', float(value)))
+
+    def set_gains(self, kp, ki, kd):
+        self.kp, self.ki, self.kd = kp, ki, kd
+        self.commands.put(('gains', (kp, ki, kd)))
+
+    def reset(self):
+        self.commands.put(('reset', None))
+
+    def read(self):
+        """TICK_DTYPE records published since the previous call."""
+        data, self._cursor = self.ring.read(self._cursor)
+        return data
+
+    def stop(self, timeout=5):
+        """Stop the loop (motor off) and wait for the process to exit."""
+        if not self.process.is_alive():
+            return
+        self.commands.put(('stop', None))
+        try:
+            kind, value = self.events.get(timeout=timeout)
+            if kind == 'stats':
+                self._stats = value
+        except queue.Empty:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def stats(self):
+        """Scheduler statistics reported by the process when it stopped."""
+        return self._stats
+
+    def close(self):
+        if self.process.pid is not None:
+            self.stop()
+        self.ring.header = self.ring.data = None
+        self.shm.close()
+        self.shm.unlink()
+
+def status(name, engine):
+    return '%s t=%7.1f SP=%5.0f RPM=%5.0f OP=%5.1f%%' \
+        % (name, engine.elapsed, engine.setpoint, engine.rpm, engine.op)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Headless iMCLab motor controller')
+    parser.add_argument('--sp', type=float, required=True, help='setpoint (rpm)')
+    parser.add_argument('--kp', type=float)
+    parser.add_argument('--ki', type=float)
+    parser.add_argument('--kd', type=float)
+    parser.add_argument('--classic', action='store_true',
+                        help='classic PID of pid_python.py instead of the hybrid controller')
+    parser.add_argument('--rate', type=float, default=10, help='control rate, 10-200 Hz')
+    parser.add_argument('--duration', type=float, help='seconds to run (default: until Ctrl+C)')
+    parser.add_argument('--port', action='append', default=[],
+                        help='serial port of a rig; repeat for several rigs')
+    parser.add_argument('--all', action='store_true', help='control every connected rig')
+    parser.add_argument('--virtual', action='store_true',
+                        help='simulated rig in simulated time (imclab_sim)')
+    parser.add_argument('--log', action='store_true', help='record each rig with ChunkedLog')
+    args = parser.parse_args(argv)
+
+    def make_engine():
+        return ControllerEngine(args.kp, args.ki, args.kd, setpoint=args.sp,
+                                hybrid=not args.classic)
+
+    def make_tick(name, log, report):
+        last = [-1]
+        def on_tick(engine):
+            if log is not None:
+                log.append(engine.elapsed, engine.op, engine.rpm, engine.setpoint)
+            if int(engine.elapsed) != last[0]:
+                last[0] = int(engine.elapsed)
+                report(name, engine)
+        return on_tick
+
+    def open_log(name):
+        if not args.log:
+            return None
+        suffix = '_' + name.replace('/', '_') if name else ''
+        # fsync=False: the control thread must not wait for the disk
+        return imclab.ChunkedLog('log_' + time.strftime('%Y%m%d_%H%M%S') + suffix, fsync=False)
+
+    if args.all or len(args.port) > 1:
+        pool = imclab.DevicePool(ports=args.port or None)
+        engines = {}
+        logs = {}
+        def loop(name, lab):
+            engine = engines[name] = make_engine()
+            logs[name] = open_log(name)
+            report = lambda n, e: pool.publish(n, line=status(n, e))
+            engine.run(lab, rate=args.rate, duration=args.duration,
+                       on_tick=make_tick(name, logs[name], report))
+        pool.start(loop)
+        try:
+            done = False
+            while not done:
+                done = pool.join(0.5)
+                for record in pool.drain():
+                    print(record.get('line') or record)
+        except KeyboardInterrupt:
+            pass
+        for engine in engines.values():
+            engine.stop()
+        pool.close()
+        for name, engine in sorted(engines.items()):
+            print(name, engine.stats())
+            if logs.get(name) is not None:
+                logs[name].close()
+        return 0
+
+    clock = time
+    if args.virtual:
+        import imclab_sim
+        clock = imclab_sim.SimClock()
+        lab = imclab_sim.VirtualIMCLab(clock=clock)
+        if args.duration is None:
+            args.duration = 30.0
+    else:
+        lab = imclab.iMCLab(port=args.port[0] if args.port else None)
+    engine = make_engine()
+    log = open_log('')
+    report = lambda n, e: print(status(n, e))
+    name = 'virtual' if args.virtual else lab.sp.port
+    try:
+        engine.run(lab, rate=args.rate, duration=args.duration,
+                   on_tick=make_tick(name, log, report), clock=clock)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        lab.op(0)
+        lab.close()
+        if log is not None:
+            log.close()
+            print('Log: ' + log.path)
+    print(engine.stats())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,377 @@
+"""
+Simulated iMCLab hardware.
+
+VirtualIMCLab is an in-process drop-in for imclab.iMCLab. Driven by a
+SimClock it runs experiments far faster than wall-clock time:
+
+    clock = SimClock()
+    lab = VirtualIMCLab(clock=clock)
+    lab.op(70); clock.sleep(2.0); print(lab.RPM)
+
+Emulator serves the protocol of imclab_arduino_python.ino on a Linux
+pseudo-terminal, backed by a DC motor model, so the real imclab.iMCLab
+driver and the apps run without a rig:
+
+    python imclab_sim.py              # prints the pty path and serves it
+    IMCLAB_PORT=/dev/pts/N python pid_python.py
+    python imclab_sim.py --bench      # driver round-trip throughput
+"""
+import os
+import re
+import sys
+import tty
+import time
+import math
+import random
+import select
+import threading
+import imclab
+from imclab import FRAME, SYNC, CMD_CODES, TELEMETRY, TSYNC, checksum
+
+CMD_NAMES = dict((code, name) for name, code in CMD_CODES.items())
+FLOAT_PREFIX = re.compile(r'[-+]?(\d+\.?\d*|\.\d+)')
+
+def to_float(text):
+    """Arduino String.toFloat(): parse the leading number, 0 if none."""
+    m = FLOAT_PREFIX.match(text)
+    return float(m.group(0)) if m else 0.0
+
+class DCMotor(object):
+    """
+    First-order DC motor with a PWM deadband, breakaway friction,
+    speed saturation and a slotted encoder disc.
+
+    Input:
+        rpm_max (float): no-load speed at 100 % PWM
+        deadband (float): PWM (%) below which the motor produces no torque
+        breakaway (float): PWM (%) needed to start a stalled motor
+        tau (float): mechanical time constant (s)
+        holes (int): encoder pulses per revolution
+        noise (float): standard deviation of the speed noise (rpm)
+    """
+
+    def __init__(self, rpm_max=6000.0, deadband=35.0, breakaway=50.0,
+                 tau=0.35, holes=2, noise=0.0, seed=None):
+        self.rpm_max = rpm_max
+        self.deadband = deadband
+        self.breakaway = breakaway
+        self.tau = tau
+        self.holes = holes
+        self.noise = noise
+        self.rng = random.Random(seed)
+        self.speed = 0.0   # true shaft speed (rpm)
+        self.revs = 0.0    # shaft revolutions since start
+
+    def steady_rpm(self, pwm):
+        pwm = max(0.0, min(100.0, pwm))
+        if pwm <= self.deadband:
+            return 0.0
+        if self.speed < 1.0 and pwm < self.breakaway:
+            return 0.0  # static friction holds the shaft
+        return self.rpm_max * (pwm - self.deadband) / (100.0 - self.deadband)
+
+    def advance(self, dt, pwm):
+        """Run for dt seconds at `pwm` percent, return the encoder pulses seen."""
+        target = self.steady_rpm(pwm)
+        a = math.exp(-dt / self.tau)
+        speed = target + (self.speed - target) * a
+        if self.noise:
+            speed += self.rng.gauss(0.0, self.noise)
+        self.speed = max(0.0, min(self.rpm_max, speed))
+        before = int(self.revs * self.holes)
+        self.revs += self.speed / 60.0 * dt
+        return int(self.revs * self.holes) - before
+
+class Firmware(object):
+    """
+    Python port of imclab_arduino_python.ino (firmware 1.3).
+
+    feed() takes the bytes the host wrote and returns the reply bytes;
+    poll() advances the motor and returns any pushed telemetry. RPM is
+    recomputed at most once per 1000 ms from the encoder count, and the
+    0.7/0.3 filtered value is kept but, like the firmware, not reported.
+    """
+
+    version = '1.3'
+    holes = 2
+
+    def __init__(self, motor=None, clock=time.monotonic):
+        self.motor = motor or DCMotor()
+        self.clock = clock
+        self.t0 = clock()
+        self.last_update = self.t0
+        self.rev = 0
+        self.last_rev_count = 0
+        self.last_rpm_time = 0
+        self.rpm = 0.0
+        self.rpm_filtered = 0.0
+        self.op = 0.0
+        self.level = 0.0
+        self.iwrite = 0       # motor PWM duty, 0-255
+        self.led_duty = 0
+        self.binary = False
+        self.stream_period = 0
+        self.last_stream = 0
+        self._rx = bytearray()
+
+    def millis(self):
+        return int((self.clock() - self.t0) * 1000) & 0xFFFFFFFF
+
+    def update(self):
+        now = self.clock()
+        dt = now - self.last_update
+        if dt > 0:
+            self.rev += self.motor.advance(dt, self.iwrite * 100.0 / 255.0)
+            self.last_update = now
+
+    def calculate_rpm(self):
+        self.update()
+        current_time = self.millis()
+        time_elapsed = current_time - self.last_rpm_time
+        if time_elapsed >= 1000:
+            rotations = float(self.rev - self.last_rev_count) / self.holes
+            self.rpm = rotations / (time_elapsed / 60000.0)
+            self.rpm_filtered = 0.7 * self.rpm_filtered + 0.3 * self.rpm
+            self.last_rev_count = self.rev
+            self.last_rpm_time = current_time
+
+    def feed(self, data):
+        self._rx += data
+        out = bytearray()
+        while True:
+            if self.binary:
+                i = self._rx.find(SYNC)
+                if i < 0:
+                    del self._rx[:]
+                    break
+                del self._rx[:i]
+                if len(self._rx) < FRAME.size:
+                    break
+                frame = self._rx[:FRAME.size]
+                del self._rx[:FRAME.size]
+                if checksum(frame) != frame[-1]:
+                    continue
+                _, code, pv, _ = FRAME.unpack(bytes(frame))
+                out += self.dispatch(code, pv)
+            else:
+                i = self._rx.find(b'\n')
+                if i < 0:
+                    break
+                line = bytes(self._rx[:min(i, 63)])
+                del self._rx[:i+1]
+                out += self.dispatch(*self.parse_line(line))
+        return bytes(out)
+
+    def parse_line(self, line):
+        text = line.split(b'\0')[0].decode('latin-1')
+        idx = text.find(' ')
+        cmd = (text if idx < 0 else text[:idx]).strip().upper()
+        pv = to_float(text[idx+1:].strip())
+        if cmd == 'V':
+            cmd = 'VER'
+        return CMD_CODES.get(cmd, 0), pv
+
+    def frame(self, code, value):
+        out = bytearray(FRAME.pack(SYNC, code, value, 0))
+        out[-1] = checksum(out)
+        return out
+
+    def reply(self, code, value):
+        if self.binary:
+            return self.frame(code, value)
+        return ('%.2f\r\n' % value).encode()
+
+    def dispatch(self, code, pv):
+        name = CMD_NAMES.get(code)
+        if name in ('OP', 'STEP'):
+            self.update()
+            self.op = max(0.0, min(100.0, pv))
+            self.iwrite = int(self.op) * 255 // 100  # Arduino map()
+            if name == 'OP':
+                return self.reply(code, self.op)
+            self.calculate_rpm()
+            return self.reply(code, self.rpm)
+        if name == 'RPM':
+            self.calculate_rpm()
+            return self.reply(code, self.rpm)
+        if name == 'VER':
+            if self.binary:
+                return self.frame(code, float(self.version))
+            return ('iMCLab Firmware Version ' + self.version + '\r\n').encode()
+        if name == 'LED':
+            self.level = max(0.0, min(100.0, pv))
+            self.led_duty = int(self.level) * 255 // 100
+            return self.reply(code, self.level)
+        if name == 'X':
+            self.update()
+            self.iwrite = 0
+            return self.frame(code, 0) if self.binary else b'Stop\r\n'
+        if name == 'BIN':
+            out = self.frame(code, pv) if self.binary else b'BIN\r\n'
+            self.binary = (pv != 0)
+            if not self.binary:
+                self.stream_period = 0
+            return out
+        if name == 'STREAM':
+            if self.binary and pv > 0:
+                rate = min(200.0, pv)
+                self.stream_period = int(1000.0 / rate)
+                self.last_stream = self.millis()
+                return self.reply(code, rate)
+            self.stream_period = 0
+            return self.reply(code, 0)
+        return b''
+
+    def poll(self):
+        self.update()
+        if not self.stream_period:
+            return b''
+        now = self.millis()
+        if now - self.last_stream < self.stream_period:
+            return b''
+        self.calculate_rpm()
+        self.last_stream = now
+        out = bytearray(TELEMETRY.pack(TSYNC, now, self.rpm, 0))
+        out[-1] = checksum(out)
+        return bytes(out)
+
+class SimClock(object):
+    """
+    Simulated time for faster-than-real-time runs. Offers time(),
+    monotonic_ns() and sleep() like the time module; sleep() advances
+    the clock at once.
+    """
+
+    def __init__(self, start=0.0):
+        self.now = float(start)
+
+    def time(self):
+        return self.now
+
+    monotonic = time
+
+    def monotonic_ns(self):
+        return int(round(self.now * 1e9))
+
+    def sleep(self, seconds):
+        self.now += max(0.0, seconds)
+
+class VirtualIMCLab(imclab.iMCLab):
+    """
+    In-process iMCLab backed by the Firmware port and a DCMotor.
+
+    Commands go through the same ASCII protocol as on the wire, so RPM,
+    op(), step(), LED(), version(), stop() and close() behave like the
+    real board, including the once-per-second RPM update.
+
+    Input:
+        motor (DCMotor): motor model, default DCMotor()
+        clock: object with time() and sleep(), e.g. SimClock() for
+            faster-than-real-time runs or the time module for real time
+    """
+
+    def __init__(self, motor=None, clock=None):
+        self.clock = clock or SimClock()
+        self.firmware = Firmware(motor, clock=self.clock.time)
+        self._stats = imclab.DriverStats()
+        self.missed = 0
+        self.binary = False
+        self._streaming = False
+        self.buffer = None
+        self._version = self.read('VER')
+
+    def read(self,cmd,timeout=None):
+        return self._exchange(cmd,self.build_cmd_str(cmd,''))
+
+    def write(self,cmd,pwm,timeout=None):
+        return self._exchange(cmd,self.build_cmd_str(cmd,(pwm,)))
+
+    def _exchange(self,cmd,cmd_str):
+        start = time.perf_counter()
+        data = cmd_str.encode()
+        raw = self.firmware.feed(data)
+        self._stats.record(cmd.upper(),start,len(data),len(raw),'ok')
+        return raw.decode('UTF-8').replace("\r\n", "")
+
+    def close(self):
+        return True
+
+class Emulator(object):
+    """
+    Serve the iMCLab firmware on a pseudo-terminal (Linux/macOS).
+
+    Open `port` with imclab.iMCLab(port=...) or export IMCLAB_PORT.
+    """
+
+    def __init__(self, motor=None):
+        self.firmware = Firmware(motor)
+        self.master, self._slave = os.openpty()
+        tty.setraw(self._slave)  # no echo or line editing on the device side
+        self.port = os.ttyname(self._slave)
+        self.running = False
+        self._thread = None
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def _serve(self):
+        while self.running:
+            r, _, _ = select.select([self.master], [], [], 0.001)
+            out = b''
+            if r:
+                try:
+                    data = os.read(self.master, 4096)
+                except OSError:
+                    break
+                out += self.firmware.feed(data)
+            out += self.firmware.poll()
+            if out:
+                os.write(self.master, out)
+
+    def stop(self):
+        self.running = False
+        if self._thread:
+            self._thread.join()
+        os.close(self.master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def benchmark(n=500):
+    """Measure round trips of the real driver against the emulator."""
+    with Emulator() as emu:
+        for protocol in ('ascii', 'binary'):
+            lab = imclab.iMCLab(port=emu.port, protocol=protocol)
+            start = time.perf_counter()
+            for i in range(n):
+                lab.op(50)
+                lab.RPM
+            pair = (time.perf_counter() - start) / n
+            start = time.perf_counter()
+            for i in range(n):
+                lab.step(50)
+            step = (time.perf_counter() - start) / n
+            lab.op(0)
+            lab.close()
+            print('%-6s op()+RPM: %7.3f ms/tick   step(): %7.3f ms/tick' \
+                  % (protocol, pair * 1000, step * 1000))
+
+if __name__ == '__main__':
+    if '--bench' in sys.argv:
+        benchmark()
+    else:
+        emu = Emulator().start()
+        print('iMCLab emulator serving on ' + emu.port)
+        print('Run an app against it with: IMCLAB_PORT=' + emu.port + ' python <app>.py')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            emu.stop()
@@ -2,11 +2,13 @@ import tkinter as tk
 from tkinter import ttk, messagebox
 import time
 import threading
-import numpy as np
 import imclab  # Library buatan sendiri
+from controller_engine import ControllerEngine
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
 
+CONTROL_RATE = 10  # Laju loop PID (Hz), 10-200
+
 class PIDApp:
     def __init__(self, root):
         self.root = root
@@ -20,14 +22,14 @@ class PIDApp:
         self.setpoint = 0.0
         self.running = False
         self.lab = None
+        # Engine PID klasik tanpa UI (hitung kontrol & jadwal loop)
+        self.engine = ControllerEngine(self.kp, self.ki, self.kd, hybrid=False)
         
-        # Data Log untuk Grafik
-        self.time_data = []
-        self.sp_data = []
-        self.rpm_data = []
-        self.out_data = []
+        # Data Log untuk Grafik: ring buffer NumPy berkapasitas tetap
+        # (append O(1), grafik membaca view tanpa menyalin)
         self.start_time = 0
         self.window_size = 100 # Menampilkan 100 data terakhir
+        self.trend = imclab.RingBuffer(self.window_size, dtype=imclab.TREND_DTYPE)
 
         # --- LAYOUT UI ---
         self.create_widgets()
@@ -121,7 +123,7 @@ class PIDApp:
             
             # Mulai Thread PID
             self.running = True
-            self.start_time = time.time()
+            self.start_time = time.monotonic()
             self.pid_thread = threading.Thread(target=self.pid_loop, daemon=True)
             self.pid_thread.start()
             
@@ -138,72 +140,29 @@ class PIDApp:
             self.kp = float(self.ent_kp.get())
             self.ki = float(self.ent_ki.get())
             self.kd = float(self.ent_kd.get())
+            self.engine.setpoint = self.setpoint
+            self.engine.set_gains(self.kp, self.ki, self.kd)
         except ValueError:
             pass # Abaikan jika input kosong/huruf
 
     def pid_loop(self):
         """Looping PID yang berjalan di background thread"""
-        prev_error = 0
-        integral = 0
-        last_time = time.time()
-
-        while self.running:
-            current_time = time.time()
-            dt = current_time - last_time
-
-            if dt >= 0.1: # Sampling 10Hz
-                # 1. Baca RPM
-                try:
-                    current_rpm = self.lab.RPM
-                except:
-                    current_rpm = 0
-
-                # 2. Hitung PID
-                error = self.setpoint - current_rpm
-                
-                # P
-                P = self.kp * error
-                
-                # I
-                integral += error * dt
-                integral = max(-100, min(100, integral)) # Anti-windup
-                I = self.ki * integral
-                
-                # D
-                D = self.kd * (error - prev_error) / dt if dt > 0 else 0
-                
-                # Total Output
-                output = P + I + D
-                output = max(0.0, min(100.0, output))
-                
-                # 3. Kirim ke Motor
-                self.lab.op(output)
-
-                # 4. Simpan Data untuk Grafik
-                elapsed = current_time - self.start_time
-                self.update_data_arrays(elapsed, self.setpoint, current_rpm, output)
-                
-                # 5. Update Label Teks UI (Gunakan after agar thread aman)
-                self.root.after(0, self.update_labels, current_rpm, output)
-
-                prev_error = error
-                last_time = current_time
-            
-            time.sleep(0.01)
+        # Loop kontrol di engine: jadwal absolut tanpa drift, satu
+        # transaksi step() per tick, RPM ditahan bila balasan hilang
+        self.engine.run(self.lab, rate=CONTROL_RATE, on_tick=self.on_tick)
+
+    def on_tick(self, engine):
+        """Dipanggil engine setiap tick (di thread PID)"""
+        # Simpan Data untuk Grafik
+        elapsed = time.monotonic() - self.start_time
+        self.update_data_arrays(elapsed, engine.setpoint, engine.pv, engine.op)
+
+        # Update Label Teks UI (Gunakan after agar thread aman)
+        self.root.after(0, self.update_labels, engine.pv, engine.op)
 
     def update_data_arrays(self, t, sp, rpm, out):
-        """Menyimpan data dan menjaga agar array tidak terlalu panjang"""
-        self.time_data.append(t)
-        self.sp_data.append(sp)
-        self.rpm_data.append(rpm)
-        self.out_data.append(out)
-
-        # Hapus data lama jika melebihi batas window
-        if len(self.time_data) > self.window_size:
-            self.time_data.pop(0)
-            self.sp_data.pop(0)
-            self.rpm_data.pop(0)
-            self.out_data.pop(0)
+        """Menyimpan data; data tertua otomatis tertimpa bila window penuh"""
+        self.trend.append(t, sp, rpm, out)
 
     def update_labels(self, rpm, out):
         self.lbl_rpm.config(text=f"RPM: {rpm:.0f}")
@@ -214,17 +173,20 @@ class PIDApp:
         if not self.running:
             return
 
-        # Update data garis
-        self.line_sp.set_data(self.time_data, self.sp_data)
-        self.line_rpm.set_data(self.time_data, self.rpm_data)
-        self.line_out.set_data(self.time_data, self.out_data)
-
-        # Rescale sumbu X dan Y otomatis
-        if self.time_data:
-            self.ax1.set_xlim(min(self.time_data), max(self.time_data) + 1)
-            self.ax1.set_ylim(0, max(3000, max(self.sp_data), max(self.rpm_data)) + 100)
+        # Update data garis dari snapshot ring buffer yang konsisten
+        # (thread PID tidak pernah menunggu GUI)
+        data = self.trend.snapshot()
+        self.line_sp.set_data(data['t'], data['sp'])
+        self.line_rpm.set_data(data['t'], data['rpm'])
+        self.line_out.set_data(data['t'], data['out'])
+
+        # Rescale sumbu X dan Y otomatis (waktu sudah terurut)
+        if len(data):
+            t_min, t_max = data['t'][0], data['t'][-1]
+            self.ax1.set_xlim(t_min, t_max + 1)
+            self.ax1.set_ylim(0, max(3000, data['sp'].max(), data['rpm'].max()) + 100)
             
-            self.ax2.set_xlim(min(self.time_data), max(self.time_data) + 1)
+            self.ax2.set_xlim(t_min, t_max + 1)
             # Y output tetap 0-100
 
         self.canvas.draw()
@@ -235,6 +197,9 @@ class PIDApp:
     def on_close(self):
         """Pembersihan saat aplikasi ditutup"""
         self.running = False
+        self.engine.stop()
+        if self.engine.sched:
+            print("Statistik loop:", self.engine.sched.stats())
         if self.lab:
             try:
                 self.lab.op(0) # Matikan motor